@@ -1,7 +1,10 @@
+import asyncio
 from fastapi import FastAPI, Response
 from .database import engine, Base
+from .schema import upgrade_schema
 from api.routes.jobs import router as jobs_router
 from api.routes.logs import router as logs_router
+from api.services.admission import admission
 from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
 app = FastAPI(title="Distributed Job Scheduler API")
@@ -14,6 +17,8 @@ app.include_router(logs_router)
 async def startup():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await upgrade_schema(conn)
+    app.state.admission_refresh = asyncio.create_task(admission.run_refresh_loop())
 
 
 @app.get("/health")
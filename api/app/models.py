@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime, Enum as SAEnum, Integer, Text
+from sqlalchemy import Column, String, DateTime, Enum as SAEnum, Integer, Float, Text, Index
 from sqlalchemy.dialects.postgresql import UUID, JSONB
 import uuid
 from datetime import datetime, timezone
@@ -7,6 +7,8 @@ from .database import Base
 
 
 class JobStatus(str, enum.Enum):
+    SCHEDULED = "SCHEDULED"
+    BLOCKED = "BLOCKED"
     PENDING = "PENDING"
     ASSIGNED = "ASSIGNED"
     PULLING = "PULLING"
@@ -21,14 +23,34 @@ class JobStatus(str, enum.Enum):
 
 class Job(Base):
     __tablename__ = "jobs"
+    __table_args__ = (
+        # Recovery looks up a dead worker's active jobs through this index.
+        Index("ix_jobs_assigned_worker_status", "assigned_worker", "status"),
+        Index("ix_jobs_array_id", "array_id"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     status = Column(SAEnum(JobStatus), default=JobStatus.PENDING, nullable=False)
     command = Column(JSONB, nullable=True)
     image_base = Column(String, default="python:3.11-slim")
     assigned_worker = Column(String, nullable=True)
+    env_key = Column(String, nullable=True)
+    priority = Column(String, default="normal", nullable=False)
+    tenant = Column(String, default="default", nullable=False)
+    depends_on = Column(JSONB, nullable=True)
+    run_at = Column(DateTime(timezone=True), nullable=True)
+    cron = Column(String, nullable=True)
+    # Tasks of a job array share one bundle (``manifest`` names it) and differ
+    # by array_index and their arguments in ``command``.
+    array_id = Column(UUID(as_uuid=True), nullable=True)
+    array_index = Column(Integer, nullable=True)
+    # Run settings and the digest of the packed bundle; older jobs keep
+    # their manifest in MinIO instead.
+    manifest = Column(JSONB, nullable=True)
 
     retries_left = Column(Integer, default=3, nullable=False)
+    max_retries = Column(Integer, default=3, nullable=False)
+    retry_backoff_secs = Column(Float, default=1.0, nullable=False)
     timeout_secs = Column(Integer, default=300, nullable=False)
 
     exit_code = Column(Integer, nullable=True)
@@ -47,7 +69,16 @@ class Job(Base):
             "command": self.command,
             "image_base": self.image_base,
             "assigned_worker": self.assigned_worker,
+            "env_key": self.env_key,
+            "priority": self.priority,
+            "tenant": self.tenant,
+            "depends_on": self.depends_on,
+            "run_at": self.run_at.isoformat() if self.run_at else None,
+            "cron": self.cron,
+            "array_id": str(self.array_id) if self.array_id else None,
+            "array_index": self.array_index,
             "retries_left": self.retries_left,
+            "retry_backoff_secs": self.retry_backoff_secs,
             "timeout_secs": self.timeout_secs,
             "exit_code": self.exit_code,
             "error_message": self.error_message,
@@ -57,3 +88,11 @@ class Job(Base):
             "started_at": self.started_at.isoformat() if self.started_at else None,
             "finished_at": self.finished_at.isoformat() if self.finished_at else None,
         }
+
+
+class SchedulerFence(Base):
+    """Highest leader fencing token seen by the database."""
+    __tablename__ = "scheduler_fence"
+
+    name = Column(String, primary_key=True)
+    token = Column(Integer, nullable=False)
@@ -0,0 +1,28 @@
+from sqlalchemy import text
+
+# create_all only creates missing tables, so a database created by an
+# earlier release is brought up to date here. Every statement is a no-op
+# once applied; add new columns, enum values and indexes at the end.
+SCHEMA_UPGRADES = [
+    "ALTER TYPE jobstatus ADD VALUE IF NOT EXISTS 'SCHEDULED'",
+    "ALTER TYPE jobstatus ADD VALUE IF NOT EXISTS 'BLOCKED'",
+    "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS env_key VARCHAR",
+    "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS priority VARCHAR NOT NULL DEFAULT 'normal'",
+    "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS tenant VARCHAR NOT NULL DEFAULT 'default'",
+    "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS depends_on JSONB",
+    "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS run_at TIMESTAMP WITH TIME ZONE",
+    "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS cron VARCHAR",
+    "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS array_id UUID",
+    "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS array_index INTEGER",
+    "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS manifest JSONB",
+    "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS max_retries INTEGER NOT NULL DEFAULT 3",
+    "ALTER TABLE jobs ADD COLUMN IF NOT EXISTS retry_backoff_secs DOUBLE PRECISION NOT NULL DEFAULT 1.0",
+    "CREATE INDEX IF NOT EXISTS ix_jobs_assigned_worker_status ON jobs (assigned_worker, status)",
+    "CREATE INDEX IF NOT EXISTS ix_jobs_array_id ON jobs (array_id)",
+]
+
+
+async def upgrade_schema(conn):
+    """Apply SCHEMA_UPGRADES on ``conn`` (after ``create_all``)."""
+    for statement in SCHEMA_UPGRADES:
+        await conn.execute(text(statement))
@@ -1,97 +1,546 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Header
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
+from datetime import datetime, timezone
+import asyncio
+import hashlib
+import os
+import random
+import re
 import uuid
 import json
+from croniter import croniter
 from sqlalchemy.ext.asyncio import AsyncSession
 from api.app.database import get_db
 from api.app.models import JobStatus
-from api.services.postgres_client import create_job, get_job_by_id
-from api.services.redis_client import enqueue_job
-from api.services.minio_client import upload_script, upload_requirements, upload_manifest
+from api.services.postgres_client import (
+    create_job, create_jobs, job_row, get_job_by_id, get_job_statuses, set_job_status, get_array_counts,
+)
+from api.services.redis_client import (
+    enqueue_job, enqueue_jobs, register_dependencies, schedule_job, schedule_jobs, track_inflight, PRIORITY_STREAMS,
+)
+from api.services.admission import admission
+from api.services.minio_client import pack_digest, stat_pack, put_pack
+from api.services.environments import env_key_for_hash, requirements_hash
 from prometheus_client import Counter
 
 router = APIRouter()
 
 JOB_SUBMISSIONS = Counter("job_submissions_total", "Total number of jobs submitted")
 
+TIMER_JITTER_SECS = float(os.getenv("TIMER_JITTER_SECS", "5"))
+MAX_BATCH_JOBS = int(os.getenv("MAX_BATCH_JOBS", "10000"))
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
 
 class JobSubmit(BaseModel):
     command: List[str] = []
     image: str = "python:3.11-slim"
     resources: dict = {"cpu": 0.5, "mem_mb": 128}
     script: Optional[str] = None
+    priority: Literal["high", "normal", "low"] = "normal"
+    depends_on: List[str] = []
+    run_at: Optional[datetime] = None
+    cron: Optional[str] = None
+    retry_backoff: float = Field(1.0, ge=0)
+
+
+class JobBatchSubmit(BaseModel):
+    """Either a list of job specs, or one ``template`` whose command is run
+    once per entry of ``params`` with that entry's arguments appended."""
+    jobs: List[JobSubmit] = []
+    template: Optional[JobSubmit] = None
+    params: List[List[str]] = []
+
+
+def _first_run(run_at: Optional[datetime], cron: Optional[str], depends_on: list) -> Optional[datetime]:
+    """When a delayed or recurring job should first run; None means now."""
+    if not run_at and not cron:
+        return None
+    if depends_on:
+        raise HTTPException(status_code=400, detail="depends_on cannot be combined with run_at or cron")
+
+    now = datetime.now(timezone.utc)
+    if run_at and run_at.tzinfo is None:
+        run_at = run_at.replace(tzinfo=timezone.utc)
+
+    if cron:
+        if not croniter.is_valid(cron):
+            raise HTTPException(status_code=400, detail=f"Invalid cron expression: {cron!r}")
+        fire = croniter(cron, max(run_at or now, now)).get_next(datetime)
+        return datetime.fromtimestamp(fire.timestamp() + random.uniform(0, TIMER_JITTER_SECS), timezone.utc)
+
+    return run_at if run_at > now else None
+
+
+def _parse_parents(depends_on: List[str]) -> list[uuid.UUID]:
+    try:
+        return [uuid.UUID(d) for d in dict.fromkeys(depends_on)]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="depends_on must contain job UUIDs")
+
+
+def _initial_status(parent_ids: list[uuid.UUID], statuses: dict) -> tuple[list, JobStatus]:
+    """Work out where a job with ``parent_ids`` starts, given their statuses.
+
+    Returns the parents that have not succeeded yet and the status the new
+    job should start in: PENDING, BLOCKED on its parents, or CANCELED when a
+    parent has already failed for good.
+    """
+    missing = [str(p) for p in parent_ids if p not in statuses]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Unknown dependencies: {missing}")
+
+    unfinished, initial = [], JobStatus.PENDING
+    for parent_id in parent_ids:
+        status, retries_left = statuses[parent_id]
+        if status == JobStatus.SUCCESS:
+            continue
+        unfinished.append(str(parent_id))
+        initial = JobStatus.BLOCKED
+        if status in (JobStatus.DEAD, JobStatus.CANCELED) or (
+            status == JobStatus.FAILED and retries_left <= 0
+        ):
+            return unfinished, JobStatus.CANCELED
+    return unfinished, initial
+
+
+async def _check_dependencies(db: AsyncSession, depends_on: List[str]) -> tuple[list, JobStatus]:
+    """Validate parent job ids and work out the new job's initial status."""
+    if not depends_on:
+        return [], JobStatus.PENDING
+    parent_ids = _parse_parents(depends_on)
+    return _initial_status(parent_ids, await get_job_statuses(db, parent_ids))
+
+
+async def _enqueue_or_hold(db: AsyncSession, job, unfinished: list):
+    """Enqueue a new job, or leave it BLOCKED/SCHEDULED until the scheduler releases it.
+
+    The job counts toward its tenant's inflight total from here until the
+    scheduler sees it finish.
+    """
+    if job.status == JobStatus.CANCELED:
+        return
+    try:
+        if job.status == JobStatus.SCHEDULED:
+            await schedule_job(str(job.id), job.run_at.timestamp(), job.tenant)
+            return
+        if unfinished:
+            remaining = await register_dependencies(str(job.id), unfinished)
+            if remaining < 0:
+                await set_job_status(db, job, JobStatus.CANCELED, "Upstream job did not succeed")
+                return
+            if remaining > 0:
+                await track_inflight(job.tenant)
+                return
+            # Every parent finished between our check and the registration.
+            await set_job_status(db, job, JobStatus.PENDING)
+        await enqueue_job(str(job.id), job.env_key, job.priority, job.tenant)
+    except Exception as e:
+        print(f"Failed to push to Redis: {e}")
 
 
 @router.post("/jobs")
-async def submit_job(job_data: JobSubmit, db: AsyncSession = Depends(get_db)):
+async def submit_job(
+    job_data: JobSubmit,
+    x_tenant: str = Header("default"),
+    db: AsyncSession = Depends(get_db),
+):
     """Legacy endpoint: JSON body submission."""
+    first_run = _first_run(job_data.run_at, job_data.cron, job_data.depends_on)
+    await admission.admit(x_tenant)
+    unfinished, initial_status = await _check_dependencies(db, job_data.depends_on)
+    if first_run:
+        initial_status = JobStatus.SCHEDULED
+
     JOB_SUBMISSIONS.inc()
 
     job = await create_job(
         db,
         command=job_data.command,
         image_base=job_data.image,
+        priority=job_data.priority,
+        tenant=x_tenant,
+        depends_on=job_data.depends_on or None,
+        run_at=first_run,
+        cron=job_data.cron,
+        retry_backoff_secs=job_data.retry_backoff,
+        status=initial_status,
     )
 
+    await _enqueue_or_hold(db, job, unfinished)
+
+    return {"job_id": str(job.id), "status": job.status.value}
+
+
+def _expand_batch(batch: JobBatchSubmit) -> list[JobSubmit]:
+    if batch.template is None:
+        return batch.jobs
+    if batch.jobs:
+        raise HTTPException(status_code=400, detail="Send either jobs or template with params, not both")
+    return [
+        batch.template.model_copy(update={"command": batch.template.command + args})
+        for args in batch.params
+    ]
+
+
+async def _enqueue_batch(db: AsyncSession, rows: list[dict], unfinished: dict):
+    """Enqueue or park a freshly inserted batch in as few round trips as possible."""
+    ready = [
+        (str(row["id"]), row["env_key"], row["priority"])
+        for row in rows if row["status"] == JobStatus.PENDING
+    ]
+    scheduled = {
+        str(row["id"]): row["run_at"].timestamp()
+        for row in rows if row["status"] == JobStatus.SCHEDULED
+    }
+    tenant = rows[0]["tenant"]
     try:
-        await enqueue_job(str(job.id))
+        if ready:
+            await enqueue_jobs(ready, tenant)
+        if scheduled:
+            await schedule_jobs(scheduled, tenant)
     except Exception as e:
-        print(f"Failed to push to Redis: {e}")
+        print(f"Failed to push batch to Redis: {e}")
 
-    return {"job_id": str(job.id), "status": job.status.value}
+    # Jobs waiting on parents take the single-job path.
+    for row in rows:
+        if row["status"] == JobStatus.BLOCKED:
+            job = await get_job_by_id(db, row["id"])
+            await _enqueue_or_hold(db, job, unfinished[row["id"]])
 
 
-@router.post("/jobs/upload")
-async def upload_job(
-    script: UploadFile = File(...),
-    requirements: UploadFile = File(None),
-    image_base: str = Form("python:3.11-slim"),
-    retries: int = Form(3),
-    timeout: int = Form(300),
-    env: str = Form("{}"),
+@router.post("/jobs/batch")
+async def submit_batch(
+    batch: JobBatchSubmit,
+    x_tenant: str = Header("default"),
     db: AsyncSession = Depends(get_db),
 ):
-    """New endpoint: multipart upload with script + requirements."""
-    JOB_SUBMISSIONS.inc()
+    """Submit many jobs with one multi-row INSERT and one pipelined enqueue.
 
-    job_id = uuid.uuid4()
+    Returns the new job ids in submission order. Parents named in
+    ``depends_on`` must already exist.
+    """
+    specs = _expand_batch(batch)
+    if not specs:
+        raise HTTPException(status_code=400, detail="Batch is empty")
+    if len(specs) > MAX_BATCH_JOBS:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {MAX_BATCH_JOBS} jobs")
+
+    first_runs = [_first_run(spec.run_at, spec.cron, spec.depends_on) for spec in specs]
+    parents = [_parse_parents(spec.depends_on) for spec in specs]
+    await admission.admit(x_tenant, len(specs))
+
+    all_parents = list({p for job_parents in parents for p in job_parents})
+    statuses = await get_job_statuses(db, all_parents) if all_parents else {}
+
+    rows, unfinished = [], {}
+    for spec, first_run, job_parents in zip(specs, first_runs, parents):
+        waiting, initial_status = _initial_status(job_parents, statuses)
+        if first_run:
+            initial_status = JobStatus.SCHEDULED
+        row = job_row(
+            command=spec.command,
+            image_base=spec.image,
+            priority=spec.priority,
+            tenant=x_tenant,
+            depends_on=spec.depends_on or None,
+            run_at=first_run,
+            cron=spec.cron,
+            retry_backoff_secs=spec.retry_backoff,
+            status=initial_status,
+        )
+        rows.append(row)
+        unfinished[row["id"]] = waiting
+
+    JOB_SUBMISSIONS.inc(len(rows))
+
+    await create_jobs(db, rows)
+    await _enqueue_batch(db, rows, unfinished)
+
+    return {"job_ids": [str(row["id"]) for row in rows]}
+
+
+def _parse_digest(value: str) -> str:
+    digest = value.strip().lower()
+    digest = digest[len("sha256:"):] if digest.startswith("sha256:") else digest
+    if not re.fullmatch(r"[0-9a-f]{64}", digest):
+        raise HTTPException(status_code=400, detail=f"Invalid SHA-256 digest: {value!r}")
+    return digest
+
+
+def _sha256_file(fileobj) -> str:
+    fileobj.seek(0)
+    h = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(1024 * 1024), b""):
+        h.update(chunk)
+    fileobj.seek(0)
+    return h.hexdigest()
+
+
+def _check_limits(cpu_limit: float, mem_limit: str):
+    if cpu_limit <= 0:
+        raise HTTPException(status_code=400, detail="cpu_limit must be positive")
+    if not re.fullmatch(r"\d+(\.\d+)?[bkmg]?b?", mem_limit.strip().lower()):
+        raise HTTPException(status_code=400, detail="mem_limit must look like 512m or 2g")
 
-    script_data = await script.read()
-    upload_script(str(job_id), script_data)
 
-    req_data = b""
-    if requirements:
-        req_data = await requirements.read()
-    upload_requirements(str(job_id), req_data)
+async def _store_bundle(
+    script: Optional[UploadFile],
+    script_sha256: str,
+    requirements: Optional[UploadFile],
+    requirements_sha256: str,
+    image_base: str,
+    retries: int,
+    timeout: int,
+    env: str,
+    cpu_limit: float,
+    mem_limit: str,
+) -> tuple[Optional[str], dict]:
+    """Pack a job's script and requirements into one stored bundle; returns
+    the env key and the manifest to keep on the job row.
+
+    Bundles are addressed by the digests of their contents, so one already
+    stored is not uploaded again, and clients may send only the digests of
+    files they uploaded before. The script streams from the request's
+    spooled upload file; requirements are read, since their content decides
+    the env key, but they are small.
+    """
+    if script_sha256:
+        script_digest = _parse_digest(script_sha256)
+        req_digest = _parse_digest(requirements_sha256) if requirements_sha256 else EMPTY_SHA256
+        digest = pack_digest(script_digest, req_digest)
+        metadata = await asyncio.to_thread(stat_pack, digest)
+        if metadata is None:
+            raise HTTPException(status_code=404, detail=f"Unknown content hash sha256:{script_digest}")
+        env_hash = metadata.get("env-hash")
+    elif script:
+        req_data = await requirements.read() if requirements else b""
+        script_digest = await asyncio.to_thread(_sha256_file, script.file)
+        req_digest = hashlib.sha256(req_data).hexdigest()
+        digest = pack_digest(script_digest, req_digest)
+        env_hash = requirements_hash(req_data)
+        header = {"script": f"sha256:{script_digest}", "requirements": f"sha256:{req_digest}"}
+        await asyncio.to_thread(put_pack, digest, header, script.file, req_data, env_hash)
+    else:
+        raise HTTPException(status_code=400, detail="Send script or script_sha256")
 
     try:
         env_dict = json.loads(env)
     except json.JSONDecodeError:
         env_dict = {}
-
     manifest = {
         "image_base": image_base,
         "retries": retries,
         "timeout": timeout,
         "env": env_dict,
+        "cpu_limit": cpu_limit,
+        "mem_limit": mem_limit,
+        "bundle": f"sha256:{digest}",
     }
-    upload_manifest(str(job_id), manifest)
+    return env_key_for_hash(image_base, env_hash), manifest
+
+
+@router.post("/jobs/upload")
+async def upload_job(
+    script: UploadFile = File(None),
+    requirements: UploadFile = File(None),
+    script_sha256: str = Form(""),
+    requirements_sha256: str = Form(""),
+    image_base: str = Form("python:3.11-slim"),
+    retries: int = Form(3),
+    retry_backoff: float = Form(1.0),
+    timeout: int = Form(300),
+    env: str = Form("{}"),
+    cpu_limit: float = Form(1.0),
+    mem_limit: str = Form("512m"),
+    priority: str = Form("normal"),
+    depends_on: str = Form(""),
+    run_at: str = Form(""),
+    cron: str = Form(""),
+    x_tenant: str = Header("default"),
+    db: AsyncSession = Depends(get_db),
+):
+    """New endpoint: multipart upload with script + requirements."""
+    if priority not in PRIORITY_STREAMS:
+        raise HTTPException(status_code=400, detail=f"priority must be one of {list(PRIORITY_STREAMS)}")
+    if retry_backoff < 0:
+        raise HTTPException(status_code=400, detail="retry_backoff must not be negative")
+    _check_limits(cpu_limit, mem_limit)
+
+    try:
+        run_at_dt = datetime.fromisoformat(run_at.replace("Z", "+00:00")) if run_at else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="run_at must be an ISO 8601 timestamp")
+
+    parents = [d.strip() for d in depends_on.split(",") if d.strip()]
+    first_run = _first_run(run_at_dt, cron or None, parents)
+    await admission.admit(x_tenant)
+    unfinished, initial_status = await _check_dependencies(db, parents)
+    if first_run:
+        initial_status = JobStatus.SCHEDULED
+
+    JOB_SUBMISSIONS.inc()
+
+    job_id = uuid.uuid4()
+
+    env_key, manifest = await _store_bundle(
+        script, script_sha256, requirements, requirements_sha256,
+        image_base, retries, timeout, env, cpu_limit, mem_limit,
+    )
 
     job = await create_job(
         db,
         job_id=job_id,
         image_base=image_base,
         retries_left=retries,
+        retry_backoff_secs=retry_backoff,
         timeout_secs=timeout,
+        env_key=env_key,
+        priority=priority,
+        tenant=x_tenant,
+        depends_on=parents or None,
+        run_at=first_run,
+        cron=cron or None,
+        manifest=manifest,
+        status=initial_status,
     )
 
+    await _enqueue_or_hold(db, job, unfinished)
+
+    return {"job_id": str(job_id), "status": job.status.value}
+
+
+def _parse_array_args(args: str, count: int) -> list[list[str]]:
+    """Per-task arguments from a JSON list (one entry, or list of entries, per
+    task), or ``count`` tasks without arguments."""
+    if not args:
+        if count < 0:
+            raise HTTPException(status_code=400, detail="count must not be negative")
+        if count > MAX_BATCH_JOBS:
+            raise HTTPException(status_code=413, detail=f"Array exceeds {MAX_BATCH_JOBS} tasks")
+        return [[] for _ in range(count)]
     try:
-        await enqueue_job(str(job_id))
-    except Exception as e:
-        print(f"Failed to push to Redis: {e}")
+        parsed = json.loads(args)
+    except json.JSONDecodeError:
+        parsed = None
+    if not isinstance(parsed, list):
+        raise HTTPException(status_code=400, detail="args must be a JSON list")
+    if len(parsed) > MAX_BATCH_JOBS:
+        raise HTTPException(status_code=413, detail=f"Array exceeds {MAX_BATCH_JOBS} tasks")
+    return [[str(a) for a in entry] if isinstance(entry, list) else [str(entry)] for entry in parsed]
+
+
+@router.post("/jobs/array")
+async def submit_array(
+    script: UploadFile = File(None),
+    requirements: UploadFile = File(None),
+    script_sha256: str = Form(""),
+    requirements_sha256: str = Form(""),
+    image_base: str = Form("python:3.11-slim"),
+    retries: int = Form(3),
+    retry_backoff: float = Form(1.0),
+    timeout: int = Form(300),
+    env: str = Form("{}"),
+    cpu_limit: float = Form(1.0),
+    mem_limit: str = Form("512m"),
+    priority: str = Form("normal"),
+    count: int = Form(0),
+    args: str = Form(""),
+    x_tenant: str = Header("default"),
+    db: AsyncSession = Depends(get_db),
+):
+    """Job array: upload one bundle and run it as many tasks.
+
+    Task ``i`` runs the script with ``args[i]`` appended to its command line
+    and ARRAY_ID / ARRAY_INDEX in its environment. Without ``args``,
+    ``count`` tasks are created.
+    """
+    if priority not in PRIORITY_STREAMS:
+        raise HTTPException(status_code=400, detail=f"priority must be one of {list(PRIORITY_STREAMS)}")
+    if retry_backoff < 0:
+        raise HTTPException(status_code=400, detail="retry_backoff must not be negative")
+    _check_limits(cpu_limit, mem_limit)
+    task_args = _parse_array_args(args, count)
+    if not task_args:
+        raise HTTPException(status_code=400, detail="Give args or a positive count")
+    await admission.admit(x_tenant, len(task_args))
+
+    array_id = uuid.uuid4()
+
+    env_key, manifest = await _store_bundle(
+        script, script_sha256, requirements, requirements_sha256,
+        image_base, retries, timeout, env, cpu_limit, mem_limit,
+    )
+
+    rows = [
+        job_row(
+            command=task,
+            image_base=image_base,
+            retries_left=retries,
+            retry_backoff_secs=retry_backoff,
+            timeout_secs=timeout,
+            env_key=env_key,
+            priority=priority,
+            tenant=x_tenant,
+            array_id=array_id,
+            array_index=index,
+            manifest=manifest,
+        )
+        for index, task in enumerate(task_args)
+    ]
+    JOB_SUBMISSIONS.inc(len(rows))
+
+    await create_jobs(db, rows)
+    await _enqueue_batch(db, rows, {})
+
+    return {"array_id": str(array_id), "tasks": len(rows)}
+
+
+def _array_summary(array_id: str, counts: dict) -> dict:
+    total = sum(counts.values())
+    if not total:
+        raise HTTPException(status_code=404, detail="Array not found")
+    succeeded = counts.get(JobStatus.SUCCESS, 0)
+    # FAILED is transient: the scheduler moves it on to RETRYING or DEAD.
+    failed = counts.get(JobStatus.DEAD, 0) + counts.get(JobStatus.CANCELED, 0)
+    done = succeeded + failed
+    if done < total:
+        status = "PENDING" if counts.get(JobStatus.PENDING, 0) == total else "RUNNING"
+    else:
+        status = "SUCCESS" if succeeded == total else "FAILED"
+    return {
+        "array_id": array_id,
+        "status": status,
+        "total": total,
+        "done": done,
+        "succeeded": succeeded,
+        "failed": failed,
+        "progress": round(done / total, 4),
+    }
+
+
+async def _get_array_counts(array_id: str, db: AsyncSession) -> dict:
+    try:
+        array_uuid = uuid.UUID(array_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid UUID")
+    return await get_array_counts(db, array_uuid)
+
+
+@router.get("/arrays/{array_id}")
+async def get_array(array_id: str, db: AsyncSession = Depends(get_db)):
+    """Aggregate status of a job array with a per-status task breakdown."""
+    counts = await _get_array_counts(array_id, db)
+    summary = _array_summary(array_id, counts)
+    summary["counts"] = {status.value: n for status, n in counts.items()}
+    return summary
+
 
-    return {"job_id": str(job_id), "status": "PENDING"}
+@router.get("/arrays/{array_id}/progress")
+async def get_array_progress(array_id: str, db: AsyncSession = Depends(get_db)):
+    summary = _array_summary(array_id, await _get_array_counts(array_id, db))
+    return {k: summary[k] for k in ("status", "total", "done", "progress")}
 
 
 @router.get("/jobs/{job_id}")
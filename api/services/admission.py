@@ -0,0 +1,96 @@
+import asyncio
+import math
+import os
+import time
+from fastapi import HTTPException
+from prometheus_client import Counter
+from api.services.redis_client import get_redis_client, PRIORITY_STREAMS, TENANT_INFLIGHT
+
+SCHEDULER_GROUP = "schedulers"
+# 0 disables a limit.
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "100000"))
+MAX_TENANT_INFLIGHT = int(os.getenv("MAX_TENANT_INFLIGHT", "0"))
+ADMISSION_REFRESH_SECS = float(os.getenv("ADMISSION_REFRESH_SECS", "1"))
+# How long a submission may wait for room before it is rejected.
+ADMISSION_BLOCK_SECS = float(os.getenv("ADMISSION_BLOCK_SECS", "0"))
+
+ADMISSION_REJECTIONS = Counter(
+    "job_admission_rejections_total", "Submissions rejected by admission control", ["reason"]
+)
+
+
+class AdmissionController:
+    """Queue-depth and per-tenant inflight limits checked against cached counters.
+
+    A background task reads the backlog of the scheduler consumer group and
+    the ``tenants:inflight`` hash every ADMISSION_REFRESH_SECS. Submissions
+    are checked against that snapshot plus whatever this process admitted
+    since, so the check itself never touches Redis.
+    """
+
+    def __init__(self):
+        self.queue_depth = 0
+        self.inflight: dict[str, int] = {}
+
+    async def refresh(self):
+        r = get_redis_client()
+        async with r.pipeline(transaction=False) as pipe:
+            for stream in PRIORITY_STREAMS.values():
+                pipe.xinfo_groups(stream)
+            pipe.hgetall(TENANT_INFLIGHT)
+            *groups, inflight = await pipe.execute(raise_on_error=False)
+
+        depth = 0
+        for stream_groups in groups:
+            if isinstance(stream_groups, Exception):
+                continue
+            for group in stream_groups:
+                if group["name"] in (SCHEDULER_GROUP, SCHEDULER_GROUP.encode()):
+                    depth += (group.get("lag") or 0) + group["pending"]
+        self.queue_depth = depth
+        if not isinstance(inflight, Exception):
+            self.inflight = {t.decode("utf-8"): int(n) for t, n in inflight.items()}
+
+    async def run_refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Admission refresh error: {e}")
+            await asyncio.sleep(ADMISSION_REFRESH_SECS)
+
+    def _over_limit(self, tenant: str, count: int):
+        if MAX_QUEUE_DEPTH and self.queue_depth + count > MAX_QUEUE_DEPTH:
+            return "queue_depth"
+        if MAX_TENANT_INFLIGHT and self.inflight.get(tenant, 0) + count > MAX_TENANT_INFLIGHT:
+            return "tenant_inflight"
+        return None
+
+    async def admit(self, tenant: str, count: int = 1):
+        """Reserve room for ``count`` jobs from ``tenant`` or raise 429.
+
+        With ADMISSION_BLOCK_SECS set, rechecks as the counters refresh for
+        up to that long before giving up.
+        """
+        deadline = time.monotonic() + ADMISSION_BLOCK_SECS
+        reason = self._over_limit(tenant, count)
+        while reason and time.monotonic() < deadline:
+            await asyncio.sleep(min(ADMISSION_REFRESH_SECS, deadline - time.monotonic()))
+            reason = self._over_limit(tenant, count)
+
+        if reason:
+            ADMISSION_REJECTIONS.labels(reason=reason).inc()
+            raise HTTPException(
+                status_code=429,
+                detail=f"Too many jobs ({reason.replace('_', ' ')} limit reached)",
+                headers={"Retry-After": str(max(1, math.ceil(ADMISSION_REFRESH_SECS)))},
+            )
+
+        # Count what we admit until the next refresh sees it in Redis.
+        self.queue_depth += count
+        self.inflight[tenant] = self.inflight.get(tenant, 0) + count
+
+
+admission = AdmissionController()
@@ -0,0 +1,67 @@
+import hashlib
+import re
+from typing import Optional
+
+_REQUIREMENT = re.compile(r"([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*(.*)")
+
+
+def _canonical_requirement(line: str) -> str:
+    # Per-requirement options (``--hash=...``) follow the specifier; they are
+    # kept, as ``--name=value`` and sorted, but must not be read as part of it.
+    line, *options = re.split(r"\s+(?=--)", line)
+    options = sorted(re.sub(r"^(--[\w-]+)\s+", r"\1=", " ".join(o.split())) for o in options)
+    match = _REQUIREMENT.fullmatch(line)
+    if not match:
+        return " ".join([line, *options])
+    name, extras, rest = match.groups()
+    name = re.sub(r"[-_.]+", "-", name).lower()
+    if extras:
+        extras = "[" + ",".join(sorted(e.strip().lower() for e in extras[1:-1].split(",") if e.strip())) + "]"
+    spec, _, marker = rest.partition(";")
+    if spec.startswith("@"):
+        spec = " @ " + spec[1:].strip()
+    else:
+        spec = ",".join(sorted(s for s in "".join(spec.split()).split(",") if s))
+    marker = " ".join(marker.split())
+    return " ".join([f"{name}{extras or ''}{spec}" + (f"; {marker}" if marker else ""), *options])
+
+
+def canonical_requirements(text: str) -> list[str]:
+    """requirements.txt reduced to what pip acts on.
+
+    Comments, blank lines, line continuations and spacing are dropped,
+    package names and extras are normalised, and packages are deduplicated
+    and sorted; option lines (``--index-url`` etc.) keep their order ahead
+    of them. Mirrors ``worker.env_resolver.canonical_requirements``.
+    """
+    options, packages = [], set()
+    for line in text.replace("\\\n", " ").splitlines():
+        line = re.sub(r"(^|\s)#.*$", "", line).strip()
+        if not line:
+            continue
+        if line.startswith("-"):
+            options.append(" ".join(line.split()))
+        else:
+            packages.add(_canonical_requirement(line))
+    return options + sorted(packages)
+
+
+def requirements_hash(requirements: bytes) -> Optional[str]:
+    """SHA-256 of the canonical requirements, or None when there are none."""
+    lines = canonical_requirements(requirements.decode("utf-8", errors="replace"))
+    if not lines:
+        return None
+    return hashlib.sha256("\n".join(lines).encode()).hexdigest()
+
+
+def env_key_for_hash(base_image: str, req_hash: Optional[str]) -> Optional[str]:
+    """Image tag the worker's env resolver will build for this bundle.
+
+    Mirrors ``worker.env_resolver.compute_cache_key`` so the scheduler can
+    route a job to workers that already hold its environment. Bundles without
+    requirements run on the base image and have no key.
+    """
+    if not req_hash:
+        return None
+    safe_base = base_image.replace(":", "-").replace("/", "-")
+    return f"{safe_base}-{req_hash[:12]}"
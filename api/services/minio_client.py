@@ -1,13 +1,26 @@
+import hashlib
 import io
 import json
 import os
+import tarfile
+import tempfile
+from typing import Optional
 from minio import Minio
 from minio.error import S3Error
+from prometheus_client import Counter
 
 MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT", "minio:9000")
 MINIO_ACCESS_KEY = os.getenv("MINIO_ROOT_USER", "minio")
 MINIO_SECRET_KEY = os.getenv("MINIO_ROOT_PASSWORD", "minio123")
 BUCKET_NAME = "jobs"
+# MinIO needs at least 5 MiB per part.
+MULTIPART_PART_SIZE = int(os.getenv("MINIO_PART_SIZE", str(16 * 1024 * 1024)))
+# Packed bundles: one gzipped tar per distinct script + requirements.
+PACK_PREFIX = "packs/sha256"
+
+BUNDLE_OBJECTS_DEDUPLICATED = Counter(
+    "bundle_objects_deduplicated_total", "Bundle uploads skipped because the content was already stored"
+)
 
 _client = None
 
@@ -26,38 +39,83 @@ def get_minio_client() -> Minio:
     return _client
 
 
-def upload_script(job_id: str, script_data: bytes):
+def _put(object_name: str, data, content_type: str, metadata: dict = None):
+    """PUT ``data``: bytes in one request, or a file object of unknown size
+    streamed in MULTIPART_PART_SIZE parts (a single PUT when it is smaller)."""
     client = get_minio_client()
-    client.put_object(
-        BUCKET_NAME,
-        f"{job_id}/script.py",
-        io.BytesIO(script_data),
-        length=len(script_data),
-        content_type="text/x-python",
-    )
+    if isinstance(data, bytes):
+        client.put_object(
+            BUCKET_NAME, object_name, io.BytesIO(data), length=len(data),
+            content_type=content_type, metadata=metadata,
+        )
+    else:
+        client.put_object(
+            BUCKET_NAME, object_name, data,
+            length=-1, part_size=MULTIPART_PART_SIZE, content_type=content_type, metadata=metadata,
+        )
 
 
-def upload_requirements(job_id: str, requirements_data: bytes):
-    client = get_minio_client()
-    client.put_object(
-        BUCKET_NAME,
-        f"{job_id}/requirements.txt",
-        io.BytesIO(requirements_data),
-        length=len(requirements_data),
-        content_type="text/plain",
-    )
+def pack_name(digest: str) -> str:
+    return f"{PACK_PREFIX}/{digest}.tar.gz"
 
 
-def upload_manifest(job_id: str, manifest: dict):
-    client = get_minio_client()
-    data = json.dumps(manifest).encode()
-    client.put_object(
-        BUCKET_NAME,
-        f"{job_id}/manifest.json",
-        io.BytesIO(data),
-        length=len(data),
-        content_type="application/json",
-    )
+def pack_digest(script_digest: str, requirements_digest: str) -> str:
+    """Content address of the bundle packing this script and requirements."""
+    return hashlib.sha256(f"{script_digest}\n{requirements_digest}".encode()).hexdigest()
+
+
+def stat_pack(digest: str) -> Optional[dict]:
+    """User metadata of a stored pack (lower-case keys, without the
+    ``x-amz-meta-`` prefix), or None if there is no such pack."""
+    try:
+        stat = get_minio_client().stat_object(BUCKET_NAME, pack_name(digest))
+    except S3Error as e:
+        if e.code in ("NoSuchKey", "NoSuchObject"):
+            return None
+        raise
+    return {
+        k.lower()[len("x-amz-meta-"):]: v
+        for k, v in (stat.metadata or {}).items()
+        if k.lower().startswith("x-amz-meta-")
+    }
+
+
+def _build_pack(header: dict, script_file, requirements: bytes):
+    """Write a gzipped tar of manifest.json, script.py and requirements.txt.
+
+    The header goes first so a reader knows what the bundle holds before
+    the script streams past. Large scripts spill to disk, not memory.
+    """
+    packed = tempfile.SpooledTemporaryFile(max_size=MULTIPART_PART_SIZE)
+    with tarfile.open(fileobj=packed, mode="w:gz") as tar:
+        header_data = json.dumps(header).encode()
+        for name, fileobj, size in (
+            ("manifest.json", io.BytesIO(header_data), len(header_data)),
+            ("script.py", script_file, script_file.seek(0, io.SEEK_END)),
+            ("requirements.txt", io.BytesIO(requirements), len(requirements)),
+        ):
+            fileobj.seek(0)
+            info = tarfile.TarInfo(name)
+            info.size = size
+            tar.addfile(info, fileobj)
+    packed.seek(0)
+    return packed
+
+
+def put_pack(digest: str, header: dict, script_file, requirements: bytes, env_hash: Optional[str]) -> bool:
+    """Store a packed bundle unless an identical one exists.
+
+    ``env_hash`` (the canonical requirements hash) is kept as object
+    metadata, so a later submission by digest can derive the env key
+    without reading the pack. Returns True if it was uploaded.
+    """
+    if stat_pack(digest) is not None:
+        BUNDLE_OBJECTS_DEDUPLICATED.inc()
+        return False
+    metadata = {"env-hash": env_hash} if env_hash else None
+    with _build_pack(header, script_file, requirements) as packed:
+        _put(pack_name(digest), packed, "application/gzip", metadata)
+    return True
 
 
 def download_manifest(job_id: str) -> dict:
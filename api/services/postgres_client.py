@@ -1,30 +1,96 @@
 import uuid
+from datetime import datetime, timezone
 from typing import Optional
+from sqlalchemy import func, insert, select
 from sqlalchemy.ext.asyncio import AsyncSession
 from api.app.models import Job, JobStatus
 
+INSERT_CHUNK_SIZE = 1000
 
-async def create_job(
-    db: AsyncSession,
+
+def job_row(
     job_id: uuid.UUID = None,
     command: list = None,
     image_base: str = "python:3.11-slim",
     retries_left: int = 3,
+    retry_backoff_secs: float = 1.0,
     timeout_secs: int = 300,
-) -> Job:
-    new_job = Job(
+    env_key: str = None,
+    priority: str = "normal",
+    tenant: str = "default",
+    depends_on: list = None,
+    run_at: datetime = None,
+    cron: str = None,
+    array_id: uuid.UUID = None,
+    array_index: int = None,
+    manifest: dict = None,
+    status: JobStatus = JobStatus.PENDING,
+) -> dict:
+    """Column values for a new job."""
+    return dict(
         id=job_id or uuid.uuid4(),
         command=command,
         image_base=image_base,
         retries_left=retries_left,
+        max_retries=retries_left,
+        retry_backoff_secs=retry_backoff_secs,
         timeout_secs=timeout_secs,
-        status=JobStatus.PENDING,
+        env_key=env_key,
+        priority=priority,
+        tenant=tenant,
+        depends_on=depends_on,
+        run_at=run_at,
+        cron=cron,
+        array_id=array_id,
+        array_index=array_index,
+        manifest=manifest,
+        status=status,
     )
+
+
+async def create_job(db: AsyncSession, **kwargs) -> Job:
+    new_job = Job(**job_row(**kwargs))
     db.add(new_job)
     await db.commit()
     await db.refresh(new_job)
     return new_job
 
 
+async def create_jobs(db: AsyncSession, rows: list[dict]):
+    """Insert many jobs (built with ``job_row``) in one transaction.
+
+    Rows go out as multi-row INSERTs of INSERT_CHUNK_SIZE, which keeps each
+    statement under the driver's bind-parameter limit.
+    """
+    for i in range(0, len(rows), INSERT_CHUNK_SIZE):
+        await db.execute(insert(Job).values(rows[i:i + INSERT_CHUNK_SIZE]))
+    await db.commit()
+
+
 async def get_job_by_id(db: AsyncSession, job_id: uuid.UUID) -> Optional[Job]:
     return await db.get(Job, job_id)
+
+
+async def get_job_statuses(db: AsyncSession, job_ids: list[uuid.UUID]) -> dict:
+    """Map job id -> (status, retries_left) for the given jobs in one query."""
+    result = await db.execute(
+        select(Job.id, Job.status, Job.retries_left).where(Job.id.in_(job_ids))
+    )
+    return {job_id: (status, retries_left) for job_id, status, retries_left in result.all()}
+
+
+async def set_job_status(db: AsyncSession, job: Job, status: JobStatus, error_message: str = None) -> Job:
+    job.status = status
+    job.updated_at = datetime.now(timezone.utc)
+    if error_message:
+        job.error_message = error_message
+    await db.commit()
+    return job
+
+
+async def get_array_counts(db: AsyncSession, array_id: uuid.UUID) -> dict:
+    """Map status -> number of tasks of a job array in that status."""
+    result = await db.execute(
+        select(Job.status, func.count()).where(Job.array_id == array_id).group_by(Job.status)
+    )
+    return {status: count for status, count in result.all()}
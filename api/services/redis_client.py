@@ -2,7 +2,37 @@ import os
 import redis.asyncio as redis
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
-JOBS_STREAM = "jobs:pending"
+PRIORITY_STREAMS = {
+    "high": "jobs:pending:high",
+    "normal": "jobs:pending",
+    "low": "jobs:pending:low",
+}
+
+DAG_INDEGREE = "dag:indegree"
+DELAYED_JOBS = "jobs:delayed"
+TENANT_INFLIGHT = "tenants:inflight"
+
+# Attach a child to its unfinished parents atomically with respect to the
+# scheduler recording parent completions (dag:done:{id}). Returns how many
+# parents the child still waits for, or -1 if one of them already failed.
+REGISTER_DEPENDENCIES_LUA = """
+local waiting = {}
+for i = 2, #ARGV do
+    local done = redis.call('get', 'dag:done:' .. ARGV[i])
+    if done == 'FAILED' then
+        return -1
+    elseif done ~= 'SUCCESS' then
+        table.insert(waiting, ARGV[i])
+    end
+end
+for _, parent in ipairs(waiting) do
+    redis.call('sadd', 'dag:children:' .. parent, ARGV[1])
+end
+if #waiting > 0 then
+    redis.call('hset', KEYS[1], ARGV[1], #waiting)
+end
+return #waiting
+"""
 
 _client = None
 
@@ -14,6 +44,44 @@ def get_redis_client() -> redis.Redis:
     return _client
 
 
-async def enqueue_job(job_id: str):
+async def enqueue_job(job_id: str, env_key: str = None, priority: str = "normal", tenant: str = None):
+    """Queue a job for assignment; with ``tenant``, also count it as inflight."""
+    await enqueue_jobs([(job_id, env_key, priority)], tenant)
+
+
+async def enqueue_jobs(jobs: list[tuple], tenant: str = None):
+    """Queue ``(job_id, env_key, priority)`` tuples in one pipelined round trip."""
+    r = get_redis_client()
+    async with r.pipeline(transaction=False) as pipe:
+        for job_id, env_key, priority in jobs:
+            fields = {"job_id": job_id}
+            if env_key:
+                fields["env_key"] = env_key
+            pipe.xadd(PRIORITY_STREAMS[priority], fields)
+        if tenant:
+            pipe.hincrby(TENANT_INFLIGHT, tenant, len(jobs))
+        await pipe.execute()
+
+
+async def register_dependencies(job_id: str, parent_ids: list[str]) -> int:
+    r = get_redis_client()
+    return await r.eval(REGISTER_DEPENDENCIES_LUA, 1, DAG_INDEGREE, job_id, *parent_ids)
+
+
+async def schedule_job(job_id: str, run_at: float, tenant: str = None):
+    """Park a job in the delay queue until ``run_at`` (epoch seconds)."""
+    await schedule_jobs({job_id: run_at}, tenant)
+
+
+async def schedule_jobs(run_ats: dict[str, float], tenant: str = None):
+    r = get_redis_client()
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.zadd(DELAYED_JOBS, run_ats)
+        if tenant:
+            pipe.hincrby(TENANT_INFLIGHT, tenant, len(run_ats))
+        await pipe.execute()
+
+
+async def track_inflight(tenant: str, delta: int = 1):
     r = get_redis_client()
-    await r.xadd(JOBS_STREAM, {"job_id": job_id})
+    await r.hincrby(TENANT_INFLIGHT, tenant, delta)
@@ -1,5 +1,6 @@
 import click
 import requests
+import hashlib
 import json
 import os
 import sys
@@ -7,6 +8,32 @@ import sys
 API_URL = os.getenv("SCHEDULER_API_URL", "http://localhost:8000")
 
 
+def _sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _post_bundle(url: str, script: str, requirements: str, data: dict, headers: dict):
+    """Submit by content hash first; upload the files only if the server
+    has not seen them before."""
+    hashes = {"script_sha256": _sha256(script)}
+    if requirements:
+        hashes["requirements_sha256"] = _sha256(requirements)
+    resp = requests.post(url, data={**data, **hashes}, headers=headers)
+    if resp.status_code != 404:
+        return resp
+
+    files = {
+        "script": ("script.py", open(script, "rb"), "text/x-python"),
+    }
+    if requirements:
+        files["requirements"] = ("requirements.txt", open(requirements, "rb"), "text/plain")
+    return requests.post(url, files=files, data=data, headers=headers)
+
+
 @click.group()
 def cli():
     """Distributed Job Scheduler CLI"""
@@ -18,25 +45,37 @@ def cli():
 @click.option("--requirements", "-r", type=click.Path(exists=True), default=None, help="Path to requirements.txt")
 @click.option("--image", "-i", default="python:3.11-slim", help="Base Docker image")
 @click.option("--retries", default=3, type=int, help="Max retries")
+@click.option("--retry-backoff", default=1.0, type=float, help="Base retry delay in seconds, doubled per retry")
 @click.option("--timeout", default=300, type=int, help="Timeout in seconds")
 @click.option("--env", "-e", default="{}", help="Environment variables as JSON string")
-def submit(script, requirements, image, retries, timeout, env):
+@click.option("--cpus", default=1.0, type=float, help="CPU limit for the job's container")
+@click.option("--memory", default="512m", help="Memory limit for the job's container, e.g. 512m or 2g")
+@click.option("--priority", "-p", default="normal", type=click.Choice(["high", "normal", "low"]), help="Priority class")
+@click.option("--depends-on", "-d", multiple=True, help="Job ID that must succeed first (repeatable)")
+@click.option("--run-at", default=None, help="ISO 8601 time to start the job at")
+@click.option("--cron", default=None, help="Cron expression for a recurring job")
+@click.option("--tenant", "-t", default="default", envvar="SCHEDULER_TENANT", help="Tenant the job is accounted to")
+def submit(script, requirements, image, retries, retry_backoff, timeout, env, cpus, memory, priority, depends_on, run_at, cron, tenant):
     """Submit a job with a script and optional requirements."""
-    files = {
-        "script": ("script.py", open(script, "rb"), "text/x-python"),
-    }
-    if requirements:
-        files["requirements"] = ("requirements.txt", open(requirements, "rb"), "text/plain")
-
     data = {
         "image_base": image,
         "retries": str(retries),
+        "retry_backoff": str(retry_backoff),
         "timeout": str(timeout),
         "env": env,
+        "cpu_limit": str(cpus),
+        "mem_limit": memory,
+        "priority": priority,
+        "depends_on": ",".join(depends_on),
+        "run_at": run_at or "",
+        "cron": cron or "",
     }
 
     try:
-        resp = requests.post(f"{API_URL}/jobs/upload", files=files, data=data)
+        resp = _post_bundle(f"{API_URL}/jobs/upload", script, requirements, data, {"X-Tenant": tenant})
+        if resp.status_code == 429:
+            click.echo(f"Rejected: {resp.json()['detail']}; retry after {resp.headers.get('Retry-After')}s", err=True)
+            sys.exit(2)
         resp.raise_for_status()
         result = resp.json()
         click.echo(f"Job submitted: {result['job_id']}")
@@ -49,6 +88,91 @@ def submit(script, requirements, image, retries, timeout, env):
         sys.exit(1)
 
 
+@cli.command("submit-batch")
+@click.argument("spec_file", type=click.File("r"))
+@click.option("--tenant", "-t", default="default", envvar="SCHEDULER_TENANT", help="Tenant the jobs are accounted to")
+def submit_batch(spec_file, tenant):
+    """Submit many jobs from a JSON file.
+
+    The file holds either {"jobs": [...]} or {"template": {...}, "params": [[...], ...]}.
+    """
+    try:
+        resp = requests.post(f"{API_URL}/jobs/batch", json=json.load(spec_file), headers={"X-Tenant": tenant})
+        if resp.status_code == 429:
+            click.echo(f"Rejected: {resp.json()['detail']}; retry after {resp.headers.get('Retry-After')}s", err=True)
+            sys.exit(2)
+        resp.raise_for_status()
+        for job_id in resp.json()["job_ids"]:
+            click.echo(job_id)
+    except requests.exceptions.ConnectionError:
+        click.echo(f"Error: Cannot connect to API at {API_URL}", err=True)
+        sys.exit(1)
+    except Exception as e:
+        click.echo(f"Error: {e}", err=True)
+        sys.exit(1)
+
+
+@cli.command("submit-array")
+@click.option("--script", "-s", required=True, type=click.Path(exists=True), help="Path to the Python script")
+@click.option("--requirements", "-r", type=click.Path(exists=True), default=None, help="Path to requirements.txt")
+@click.option("--image", "-i", default="python:3.11-slim", help="Base Docker image")
+@click.option("--count", "-n", default=0, type=int, help="Number of tasks (when --args is not given)")
+@click.option("--args", "args_file", type=click.File("r"), default=None, help="JSON file with one argument list per task")
+@click.option("--retries", default=3, type=int, help="Max retries per task")
+@click.option("--retry-backoff", default=1.0, type=float, help="Base retry delay in seconds, doubled per retry")
+@click.option("--timeout", default=300, type=int, help="Timeout in seconds")
+@click.option("--env", "-e", default="{}", help="Environment variables as JSON string")
+@click.option("--cpus", default=1.0, type=float, help="CPU limit for the job's container")
+@click.option("--memory", default="512m", help="Memory limit for the job's container, e.g. 512m or 2g")
+@click.option("--priority", "-p", default="normal", type=click.Choice(["high", "normal", "low"]), help="Priority class")
+@click.option("--tenant", "-t", default="default", envvar="SCHEDULER_TENANT", help="Tenant the tasks are accounted to")
+def submit_array(script, requirements, image, count, args_file, retries, retry_backoff, timeout, env, cpus, memory, priority, tenant):
+    """Submit one script as a job array of many tasks."""
+    data = {
+        "image_base": image,
+        "retries": str(retries),
+        "retry_backoff": str(retry_backoff),
+        "timeout": str(timeout),
+        "env": env,
+        "cpu_limit": str(cpus),
+        "mem_limit": memory,
+        "priority": priority,
+        "count": str(count),
+        "args": args_file.read() if args_file else "",
+    }
+
+    try:
+        resp = _post_bundle(f"{API_URL}/jobs/array", script, requirements, data, {"X-Tenant": tenant})
+        if resp.status_code == 429:
+            click.echo(f"Rejected: {resp.json()['detail']}; retry after {resp.headers.get('Retry-After')}s", err=True)
+            sys.exit(2)
+        resp.raise_for_status()
+        result = resp.json()
+        click.echo(f"Array submitted: {result['array_id']} ({result['tasks']} tasks)")
+    except requests.exceptions.ConnectionError:
+        click.echo(f"Error: Cannot connect to API at {API_URL}", err=True)
+        sys.exit(1)
+    except Exception as e:
+        click.echo(f"Error: {e}", err=True)
+        sys.exit(1)
+
+
+@cli.command("array-status")
+@click.argument("array_id")
+def array_status(array_id):
+    """Check the aggregate status of a job array."""
+    try:
+        resp = requests.get(f"{API_URL}/arrays/{array_id}")
+        resp.raise_for_status()
+        click.echo(json.dumps(resp.json(), indent=2))
+    except requests.exceptions.ConnectionError:
+        click.echo(f"Error: Cannot connect to API at {API_URL}", err=True)
+        sys.exit(1)
+    except Exception as e:
+        click.echo(f"Error: {e}", err=True)
+        sys.exit(1)
+
+
 @cli.command()
 @click.argument("job_id")
 def status(job_id):
@@ -0,0 +1,157 @@
+import os
+import uuid
+from datetime import datetime, timezone
+import redis.asyncio as redis
+from sqlalchemy import update
+from .database import get_db_session
+from .models import Job, JobStatus
+from .queues import stream_for, stream_entry, TENANT_INFLIGHT
+
+DAG_INDEGREE = "dag:indegree"
+DAG_STATUS_TTL = int(os.getenv("DAG_STATUS_TTL", str(7 * 24 * 3600)))
+
+# Record the parent's outcome (the API's registration script checks it to
+# close the submit/complete race) and work out which children it affects.
+# On success, returns the children whose last dependency has cleared; on
+# failure, returns every child so the caller can cancel them. The children
+# stay attached, and the indegree is only decremented the first time, so a
+# replayed event finds the same children until FINISH_LUA detaches them
+# after the database has been updated (dag:applied marks the decrement).
+COMPLETE_LUA = """
+redis.call('set', 'dag:done:' .. ARGV[1], ARGV[2], 'EX', ARGV[3])
+local children = redis.call('smembers', 'dag:children:' .. ARGV[1])
+local first = redis.call('set', 'dag:applied:' .. ARGV[1], '1', 'NX', 'EX', ARGV[3])
+local out = {}
+for _, child in ipairs(children) do
+    if ARGV[2] ~= 'SUCCESS' then
+        table.insert(out, child)
+    else
+        local left
+        if first then
+            left = redis.call('hincrby', KEYS[1], child, -1)
+        else
+            left = tonumber(redis.call('hget', KEYS[1], child) or '0')
+        end
+        if left <= 0 then
+            table.insert(out, child)
+        end
+    end
+end
+return out
+"""
+
+# Detach a parent's children once their new state is committed. Children
+# that are ready (or canceled) no longer need an indegree entry.
+FINISH_LUA = """
+redis.call('del', 'dag:children:' .. ARGV[1], 'dag:applied:' .. ARGV[1])
+for i = 2, #ARGV do
+    redis.call('hdel', KEYS[1], ARGV[i])
+end
+return 1
+"""
+
+
+async def _complete(r: redis.Redis, job_id: str, outcome: str) -> list[uuid.UUID]:
+    children = await r.eval(COMPLETE_LUA, 1, DAG_INDEGREE, job_id, outcome, DAG_STATUS_TTL)
+    return [uuid.UUID(c.decode("utf-8")) for c in children]
+
+
+async def _finish(r: redis.Redis, job_id: str, children: list[uuid.UUID]):
+    await r.eval(FINISH_LUA, 1, DAG_INDEGREE, job_id, *[str(c) for c in children])
+
+
+async def release_children(r: redis.Redis, job_id: str) -> int:
+    """Enqueue the children of a succeeded job whose dependencies are all met.
+
+    Safe to repeat: children an earlier attempt already made PENDING are
+    enqueued again (``assign_jobs`` and the worker weed out duplicates),
+    and they are only detached from the parent once enqueued.
+    """
+    ready = await _complete(r, job_id, "SUCCESS")
+    if not ready:
+        await _finish(r, job_id, [])
+        return 0
+
+    async_session = get_db_session()
+    async for session in async_session:
+        try:
+            result = await session.execute(
+                update(Job)
+                .where(Job.id.in_(ready), Job.status.in_([JobStatus.BLOCKED, JobStatus.PENDING]))
+                .values(status=JobStatus.PENDING, updated_at=datetime.now(timezone.utc))
+                .returning(Job.id, Job.priority, Job.env_key)
+                .execution_options(synchronize_session=False)
+            )
+            released = result.all()
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
+
+    async with r.pipeline(transaction=False) as pipe:
+        for child_id, priority, env_key in released:
+            pipe.xadd(stream_for(priority), stream_entry(str(child_id), env_key))
+        await pipe.execute()
+    await _finish(r, job_id, ready)
+
+    print(f"Job {job_id} succeeded: released {len(released)} dependent jobs")
+    return len(released)
+
+
+async def cancel_descendants(r: redis.Redis, job_id: str) -> int:
+    """Cancel every job downstream of a job that will never succeed.
+
+    Parents are only detached from their children once the whole subtree is
+    canceled, so a replay after a failure part way walks it again; children
+    an earlier attempt already canceled are walked but not counted twice.
+    """
+    canceled = 0
+    frontier = [job_id]
+    detach, seen = [], {job_id}
+    while frontier:
+        children = []
+        for parent in frontier:
+            found = await _complete(r, parent, "FAILED")
+            detach.append((parent, found))
+            children.extend(c for c in found if str(c) not in seen)
+            seen.update(str(c) for c in found)
+        if not children:
+            break
+
+        async_session = get_db_session()
+        async for session in async_session:
+            try:
+                result = await session.execute(
+                    update(Job)
+                    .where(Job.id.in_(children), Job.status == JobStatus.BLOCKED)
+                    .values(
+                        status=JobStatus.CANCELED,
+                        error_message=f"Upstream job {job_id} did not succeed",
+                        updated_at=datetime.now(timezone.utc),
+                    )
+                    .returning(Job.id, Job.tenant)
+                    .execution_options(synchronize_session=False)
+                )
+                rows = result.all()
+                await session.commit()
+            except Exception:
+                await session.rollback()
+                raise
+            finally:
+                await session.close()
+
+        frontier = [str(child_id) for child_id in children]
+        canceled += len(rows)
+        if rows:
+            async with r.pipeline(transaction=False) as pipe:
+                for _, tenant in rows:
+                    pipe.hincrby(TENANT_INFLIGHT, tenant, -1)
+                await pipe.execute()
+
+    for parent, children in detach:
+        await _finish(r, parent, children)
+    if canceled:
+        print(f"Job {job_id} failed: canceled {canceled} downstream jobs")
+    return canceled
@@ -0,0 +1,125 @@
+import asyncio
+import os
+import redis.asyncio as redis
+from .dag import release_children, cancel_descendants
+from .timers import rearm_cron
+from .retries import schedule_retries, mark_exhausted
+from .models import JobStatus
+from .queues import TENANT_INFLIGHT
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+EVENTS_STREAM = "jobs:events"
+EVENTS_GROUP = "schedulers"
+EVENTS_MAXLEN = int(os.getenv("EVENTS_MAXLEN", "100000"))
+SCHEDULER_CONSUMER = os.getenv("HOSTNAME", "scheduler-1")
+# Events another consumer (a previous leader) read but left unacknowledged
+# for this long are claimed and replayed.
+EVENTS_CLAIM_IDLE_MS = int(os.getenv("EVENTS_CLAIM_IDLE_MS", "10000"))
+EVENTS_CLAIM_INTERVAL_SECS = float(os.getenv("EVENTS_CLAIM_INTERVAL_SECS", "15"))
+
+
+def is_terminal_failure(status: str, retries_left: int) -> bool:
+    if status in (JobStatus.DEAD.value, JobStatus.CANCELED.value):
+        return True
+    return status == JobStatus.FAILED.value and retries_left <= 0
+
+
+def queue_event(pipe, job_id: str, status: str, retries_left: int = 0, tenant: str = None):
+    """Queue a job state change for the scheduler's event loop on ``pipe``."""
+    fields = {"job_id": job_id, "status": status, "retries_left": retries_left}
+    if tenant:
+        fields["tenant"] = tenant
+    pipe.xadd(
+        EVENTS_STREAM,
+        fields,
+        maxlen=EVENTS_MAXLEN,
+        approximate=True,
+    )
+
+
+async def handle_event(r: redis.Redis, job_id: str, status: str, retries_left: int, tenant: str = None):
+    if status == JobStatus.SUCCESS.value:
+        await release_children(r, job_id)
+    elif status == JobStatus.FAILED.value and retries_left > 0:
+        await schedule_retries(r, [job_id])
+        return
+    elif is_terminal_failure(status, retries_left):
+        if status == JobStatus.FAILED.value:
+            await mark_exhausted(job_id)
+        await cancel_descendants(r, job_id)
+    else:
+        return
+    # A recurring job stays inflight between its runs.
+    if not await rearm_cron(r, job_id) and tenant:
+        await r.hincrby(TENANT_INFLIGHT, tenant, -1)
+
+
+async def claim_stale_events(r: redis.Redis, min_idle_ms: int = EVENTS_CLAIM_IDLE_MS) -> int:
+    """Move events left unacknowledged by other consumers into this one's
+    pending list, so the next replay handles them."""
+    claimed, start = 0, "0-0"
+    while True:
+        result = await r.xautoclaim(
+            EVENTS_STREAM, EVENTS_GROUP, SCHEDULER_CONSUMER, min_idle_ms, start, count=500
+        )
+        start = result[0]
+        claimed += len(result[1])
+        if start in (b"0-0", "0-0"):
+            return claimed
+
+
+async def run_event_loop():
+    """Consume job completion/failure events as soon as they are emitted."""
+    print("Event loop started...")
+    r = redis.from_url(REDIS_URL)
+
+    try:
+        await r.xgroup_create(EVENTS_STREAM, EVENTS_GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            print(f"Redis Group Error: {e}")
+
+    # Start (and restart after any error) by replaying events this consumer
+    # read but never acknowledged, then follow new ones. Events a previous
+    # leader left behind are claimed now and then and replayed the same way.
+    last_id = "0"
+    next_claim = 0.0
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            if loop.time() >= next_claim:
+                next_claim = loop.time() + EVENTS_CLAIM_INTERVAL_SECS
+                if await claim_stale_events(r):
+                    last_id = "0"
+            streams = await r.xreadgroup(
+                EVENTS_GROUP,
+                SCHEDULER_CONSUMER,
+                {EVENTS_STREAM: last_id},
+                count=100,
+                block=None if last_id != ">" else 2000,
+            )
+            messages = streams[0][1] if streams else []
+
+            if last_id != ">":
+                if not messages:
+                    last_id = ">"
+                    continue
+                last_id = messages[-1][0]
+
+            for message_id, data in messages:
+                # Entries trimmed from the stream replay without fields.
+                data = data or {}
+                job_id = data.get(b"job_id", b"").decode("utf-8")
+                status = data.get(b"status", b"").decode("utf-8")
+                retries_left = int(data.get(b"retries_left", 0))
+                tenant = data.get(b"tenant", b"").decode("utf-8") or None
+                if job_id:
+                    await handle_event(r, job_id, status, retries_left, tenant)
+                await r.xack(EVENTS_STREAM, EVENTS_GROUP, message_id)
+
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Event loop error: {e}")
+            last_id = "0"
+            await asyncio.sleep(1)
@@ -1,126 +1,268 @@
 import asyncio
 import os
+import uuid
 from datetime import datetime, timezone
 import redis.asyncio as redis
-from sqlalchemy.future import select
+from typing import Optional
+from sqlalchemy import case, select, update
+from sqlalchemy.dialects.postgresql import insert
 from .database import get_db_session
-from .models import Job, JobStatus
+from .leader_election import StaleLeaderError
+from .models import Job, JobStatus, SchedulerFence
+from .placement import get_strategy
+from .queues import PRIORITY_STREAMS, ensure_groups, read_weighted, reclaim_idle
+from .worker_registry import CapacitySignal, WorkerRegistry
 from prometheus_client import Counter, Gauge
 
 JOBS_SCHEDULED = Counter("jobs_scheduled_total", "Total number of jobs successfully scheduled")
 ACTIVE_WORKERS = Gauge("active_workers", "Number of currently active workers")
+JOBS_RECLAIMED = Counter("jobs_reclaimed_total", "Stranded pending stream entries requeued by the leader")
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
-JOBS_STREAM = "jobs:pending"
 SCHEDULER_GROUP = "schedulers"
 SCHEDULER_CONSUMER = os.getenv("HOSTNAME", "scheduler-1")
-WORKERS_SET = "available_workers"
+ASSIGN_BATCH_SIZE = int(os.getenv("ASSIGN_BATCH_SIZE", "50"))
+DISPATCH_MAXLEN = int(os.getenv("DISPATCH_MAXLEN", "10000"))
+CAPACITY_WAIT_SECS = float(os.getenv("CAPACITY_WAIT_SECS", "5"))
+RECLAIM_INTERVAL_SECS = float(os.getenv("RECLAIM_INTERVAL_SECS", "15"))
+RECLAIM_IDLE_MS = int(os.getenv("RECLAIM_IDLE_MS", "60000"))
 
+STREAM_RANK = {stream: rank for rank, stream in enumerate(PRIORITY_STREAMS.values())}
 
-async def run_assignment_loop():
-    """Main scheduler loop: read pending jobs, assign to workers via Pub/Sub."""
+
+async def run_assignment_loop(fencing_token: int = None, registry: WorkerRegistry = None):
+    """Main scheduler loop: read pending jobs in batches, dispatch to per-worker streams.
+
+    A leader passes its ``fencing_token`` so its writes stop the moment a
+    newer leader has written, and may pass the ``registry`` it kept warm
+    while following.
+    """
     r = redis.from_url(REDIS_URL)
+    choose_worker = get_strategy()
+    registry = registry or WorkerRegistry(r)
+    capacity = CapacitySignal(r)
 
     try:
-        await r.xgroup_create(JOBS_STREAM, SCHEDULER_GROUP, mkstream=True)
-        print(f"Created consumer group {SCHEDULER_GROUP}")
+        await ensure_groups(r, SCHEDULER_GROUP)
     except redis.ResponseError as e:
-        if "BUSYGROUP" in str(e):
-            print(f"Consumer group {SCHEDULER_GROUP} already exists")
-        else:
-            print(f"Redis Group Error: {e}")
+        print(f"Redis Group Error: {e}")
+    await capacity.start()
 
     print("Scheduler loop active processing jobs...")
 
+    # Entries read but not yet placed, kept across iterations (still
+    # unacknowledged) until a worker has room for them.
+    backlog = []
     while True:
         try:
-            streams = await r.xreadgroup(
-                SCHEDULER_GROUP,
-                SCHEDULER_CONSUMER,
-                {JOBS_STREAM: ">"},
-                count=10,
-                block=2000,
-            )
+            room = ASSIGN_BATCH_SIZE - len(backlog)
+            entries = []
+            if room > 0:
+                entries = await read_weighted(
+                    r, SCHEDULER_GROUP, SCHEDULER_CONSUMER, room,
+                    block_ms=None if backlog else 2000,
+                )
 
-            if not streams:
+            if not entries and not backlog:
                 await asyncio.sleep(0.1)
                 continue
 
-            for stream, messages in streams:
-                for message_id, data in messages:
-                    job_id = data.get(b"job_id", b"").decode("utf-8")
-                    if not job_id:
-                        await r.xack(JOBS_STREAM, SCHEDULER_GROUP, message_id)
-                        continue
-
-                    print(f"Processing job {job_id}...")
-
-                    workers = await r.smembers(WORKERS_SET)
-                    if not workers:
-                        print("No workers available! waiting...")
-                        await asyncio.sleep(2)
-                        continue
-
-                    valid_workers = []
-                    for w_bytes in workers:
-                        w_id = w_bytes.decode("utf-8")
-                        if await r.exists(f"worker:heartbeat:{w_id}"):
-                            valid_workers.append(w_id)
-                        else:
-                            print(f"Removing dead worker from set: {w_id}")
-                            await r.srem(WORKERS_SET, w_id)
-
-                    ACTIVE_WORKERS.set(len(valid_workers))
-
-                    if not valid_workers:
-                        print("No alive workers available! waiting...")
-                        await asyncio.sleep(2)
-                        continue
-
-                    worker_id = valid_workers[0]
-
-                    if await assign_job(job_id, worker_id):
-                        await r.publish(f"worker:{worker_id}:jobs", job_id)
-                        JOBS_SCHEDULED.inc()
-                        print(f"Assigned job {job_id} to {worker_id}")
-                        await r.xack(JOBS_STREAM, SCHEDULER_GROUP, message_id)
-                    else:
-                        print(f"Failed to assign job {job_id}")
-                        await r.xack(JOBS_STREAM, SCHEDULER_GROUP, message_id)
+            batch, to_ack = list(backlog), []
+            for stream, message_id, data in entries:
+                job_id = _parse_job_id(data)
+                if job_id is None:
+                    to_ack.append((stream, message_id))
+                else:
+                    env_key = data.get(b"env_key", b"").decode("utf-8") or None
+                    batch.append((stream, message_id, job_id, env_key))
+
+            if to_ack:
+                async with r.pipeline(transaction=False) as pipe:
+                    _ack(pipe, to_ack)
+                    await pipe.execute()
+            if not batch:
+                continue
+
+            # Keep the batch highest priority first, so when capacity runs
+            # out it is the low-priority tail that waits.
+            batch.sort(key=lambda entry: STREAM_RANK[entry[0]])
+            backlog = []
+
+            workers = await registry.live_workers()
+            ACTIVE_WORKERS.set(len(workers))
+
+            placements, placed = {}, []
+            for stream, message_id, job_id, env_key in batch:
+                chosen = choose_worker(workers, env_key)
+                if chosen is None:
+                    break
+                # Count the slot locally so the rest of the batch spreads out.
+                chosen.in_use += 1
+                placements[job_id] = chosen
+                placed.append((stream, message_id, job_id))
+            backlog = batch[len(placed):]
+
+            if placements:
+                assigned = await assign_jobs(
+                    {job_id: w.worker_id for job_id, w in placements.items()}, fencing_token
+                )
+
+                live, held = {w.worker_id for w in workers}, set()
+                async with r.pipeline(transaction=False) as pipe:
+                    for job_id, worker in placements.items():
+                        target = assigned.get(job_id)
+                        if target != worker.worker_id:
+                            worker.in_use -= 1
+                        if target is None:
+                            print(f"Job {job_id} was not PENDING, skipping")
+                            continue
+                        if target not in live:
+                            # Still ASSIGNED to a dead worker: recovery is
+                            # requeueing it. Leave the entry unacknowledged
+                            # for the reclaim loop rather than lose it.
+                            held.add(job_id)
+                            continue
+                        registry.count_assignment(pipe, target)
+                        pipe.xadd(
+                            f"worker:{target}:dispatch",
+                            {"job_id": str(job_id)},
+                            maxlen=DISPATCH_MAXLEN,
+                            approximate=True,
+                        )
+                    _ack(pipe, [(s, m) for s, m, job_id in placed if job_id not in held])
+                    await pipe.execute()
+
+                JOBS_SCHEDULED.inc(len(assigned) - len(held))
+                print(f"Assigned {len(assigned) - len(held)}/{len(batch)} jobs")
+
+            if backlog:
+                if not workers:
+                    print(f"No alive workers available! {len(backlog)} jobs waiting...")
+                else:
+                    print(f"All workers at capacity! {len(backlog)} jobs waiting...")
+                await _wait_for_capacity(r, capacity, registry, backlog)
 
         except asyncio.CancelledError:
             print("Scheduler loop cancelled.")
             raise
+        except StaleLeaderError as e:
+            # Unacked entries stay pending for the new leader to reclaim.
+            print(f"Scheduler loop fenced off: {e}")
+            return
         except Exception as e:
             print(f"Error in scheduler loop: {e}")
             await asyncio.sleep(5)
 
 
-async def assign_job(job_id: str, worker_id: str) -> bool:
-    """Atomic assignment with optimistic locking."""
-    async_session = get_db_session()
-    async for session in async_session:
+async def _wait_for_capacity(r: redis.Redis, capacity: CapacitySignal, registry: WorkerRegistry, backlog: list):
+    """Block until a worker frees a slot (or CAPACITY_WAIT_SECS passes).
+
+    The held entries are claimed again first so their idle time restarts
+    and the reclaim loop does not hand them to another replica meanwhile.
+    """
+    async with r.pipeline(transaction=False) as pipe:
+        by_stream = {}
+        for stream, message_id, _, _ in backlog:
+            by_stream.setdefault(stream, []).append(message_id)
+        for stream, message_ids in by_stream.items():
+            pipe.xclaim(stream, SCHEDULER_GROUP, SCHEDULER_CONSUMER, 0, message_ids, justid=True)
+        await pipe.execute()
+
+    if await capacity.wait(CAPACITY_WAIT_SECS):
+        await registry.refresh()
+
+
+async def run_reclaim_loop():
+    """Leader only: requeue stream entries stranded in the group's pending
+    list, e.g. by a scheduler that crashed or was fenced off mid-batch."""
+    print("Reclaim loop started...")
+    r = redis.from_url(REDIS_URL)
+    while True:
         try:
-            result = await session.execute(select(Job).where(Job.id == job_id))
-            job = result.scalar_one_or_none()
+            await asyncio.sleep(RECLAIM_INTERVAL_SECS)
+            moved = await reclaim_idle(r, SCHEDULER_GROUP, SCHEDULER_CONSUMER, RECLAIM_IDLE_MS)
+            if moved:
+                JOBS_RECLAIMED.inc(moved)
+                print(f"Reclaimed {moved} stranded pending jobs")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Reclaim loop error: {e}")
+            await asyncio.sleep(5)
+
+
+def _ack(pipe, entries: list[tuple[str, bytes]]):
+    by_stream = {}
+    for stream, message_id in entries:
+        by_stream.setdefault(stream, []).append(message_id)
+    for stream, message_ids in by_stream.items():
+        pipe.xack(stream, SCHEDULER_GROUP, *message_ids)
+
+
+def _parse_job_id(data: dict) -> Optional[uuid.UUID]:
+    try:
+        return uuid.UUID(data.get(b"job_id", b"").decode("utf-8"))
+    except ValueError:
+        return None
+
+
+async def _check_fence(session, fencing_token: int):
+    """Record ``fencing_token`` as the newest, or raise if a newer one exists.
 
-            if not job:
-                return False
+    The fence row stays locked until the caller's transaction ends, so a new
+    leader's first write waits for an in-flight write of the old one.
+    """
+    stmt = insert(SchedulerFence).values(name="leader", token=fencing_token)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[SchedulerFence.name],
+        set_={"token": stmt.excluded.token},
+        where=SchedulerFence.token <= stmt.excluded.token,
+    ).returning(SchedulerFence.token)
+    if (await session.execute(stmt)).first() is None:
+        raise StaleLeaderError(f"fencing token {fencing_token} is stale")
 
-            if job.status != JobStatus.PENDING:
-                print(f"Job {job_id} is already {job.status}")
-                return True
 
-            job.assigned_worker = worker_id
-            job.status = JobStatus.ASSIGNED
-            job.updated_at = datetime.now(timezone.utc)
+async def assign_jobs(placements: dict[uuid.UUID, str], fencing_token: int = None) -> dict[uuid.UUID, str]:
+    """Claim a batch of PENDING jobs for their chosen workers.
+
+    One conditional UPDATE ... RETURNING per batch. Jobs already ASSIGNED
+    are returned with the worker they were assigned to: their entry is being
+    delivered again because the dispatch after an earlier commit may never
+    have happened, so they are dispatched again (the worker drops
+    duplicates). Jobs that are missing or further along are absent from the
+    returned mapping. With a ``fencing_token`` the batch is only written if
+    no newer leader has written before it.
+    """
+    async_session = get_db_session()
+    async for session in async_session:
+        try:
+            if fencing_token is not None:
+                await _check_fence(session, fencing_token)
+            result = await session.execute(
+                update(Job)
+                .where(Job.id.in_(list(placements)), Job.status == JobStatus.PENDING)
+                .values(
+                    status=JobStatus.ASSIGNED,
+                    assigned_worker=case(placements, value=Job.id),
+                    updated_at=datetime.now(timezone.utc),
+                )
+                .returning(Job.id, Job.assigned_worker)
+                .execution_options(synchronize_session=False)
+            )
+            assigned = dict(result.all())
+            rest = [job_id for job_id in placements if job_id not in assigned]
+            if rest:
+                result = await session.execute(
+                    select(Job.id, Job.assigned_worker)
+                    .where(Job.id.in_(rest), Job.status == JobStatus.ASSIGNED)
+                )
+                assigned.update(result.all())
             await session.commit()
-            return True
+            return assigned
         except Exception as e:
-            print(f"DB Error assigning job: {e}")
+            print(f"DB Error assigning jobs: {e}")
             await session.rollback()
-            return False
+            raise
         finally:
             await session.close()
-        break
-    return False
+    return {}
@@ -1,28 +1,81 @@
 import asyncio
 import os
 import redis.asyncio as redis
+from prometheus_client import Histogram
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 LEADER_KEY = "scheduler:leader"
-LEASE_TTL_MS = 10000
-HEARTBEAT_INTERVAL = 5
+LEADER_EPOCH = "scheduler:leader:epoch"
+LEADER_SEEN = "scheduler:leader:seen"
+LEASE_TTL_MS = int(os.getenv("LEASE_TTL_MS", "1500"))
+# Refresh three times per lease so one slow round trip does not lose it.
+HEARTBEAT_INTERVAL = LEASE_TTL_MS / 3000
+FOLLOWER_POLL_MS = int(os.getenv("FOLLOWER_POLL_MS", "100"))
 SCHEDULER_CONSUMER = os.getenv("HOSTNAME", "scheduler-1")
 
+LEADER_FAILOVER = Histogram(
+    "leader_failover_seconds",
+    "Time from the previous leader's last lease refresh to a new leader taking over",
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30),
+)
+
+# Take the lease and, on success, hand out the next fencing token. Returns
+# {token, previous leader's last-seen ms or -1, now ms}, or nil when someone
+# else holds the lease.
+ACQUIRE_LUA = """
+local t = redis.call('time')
+local now = t[1] * 1000 + math.floor(t[2] / 1000)
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    local last = tonumber(redis.call('get', KEYS[3]) or '-1')
+    local token = redis.call('incr', KEYS[2])
+    redis.call('set', KEYS[3], now)
+    return {token, last, now}
+elseif redis.call('get', KEYS[1]) == ARGV[1] then
+    return {tonumber(redis.call('get', KEYS[2]) or '0'), -1, now}
+end
+return nil
+"""
+
 REFRESH_LUA = """
 if redis.call('get', KEYS[1]) == ARGV[1] then
+    local t = redis.call('time')
+    redis.call('set', KEYS[2], t[1] * 1000 + math.floor(t[2] / 1000))
     return redis.call('pexpire', KEYS[1], ARGV[2])
 else
     return 0
 end
 """
 
+RELEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    local t = redis.call('time')
+    redis.call('set', KEYS[2], t[1] * 1000 + math.floor(t[2] / 1000))
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class StaleLeaderError(Exception):
+    """A write was rejected because a newer leader has taken over."""
+
 
 class RedisLeaderElection:
+    """Lease-based election with fencing tokens.
+
+    Every successful acquisition increments ``scheduler:leader:epoch`` and
+    the new value becomes this leader's ``token``. Writers pass the token
+    along so that a leader that lost its lease without noticing (a long GC
+    pause, a network partition) is rejected by storage that has already
+    seen a newer one.
+    """
+
     def __init__(self, redis_url: str = None, instance_id: str = None):
         self.redis_url = redis_url or REDIS_URL
         self.instance_id = instance_id or SCHEDULER_CONSUMER
         self._r = None
         self._is_leader = False
+        self.token = None
 
     async def _get_redis(self) -> redis.Redis:
         if self._r is None:
@@ -31,34 +84,46 @@ class RedisLeaderElection:
 
     async def acquire(self) -> bool:
         r = await self._get_redis()
-        result = await r.set(
-            LEADER_KEY,
-            self.instance_id,
-            nx=True,
-            px=LEASE_TTL_MS,
+        result = await r.eval(
+            ACQUIRE_LUA, 3, LEADER_KEY, LEADER_EPOCH, LEADER_SEEN,
+            self.instance_id, str(LEASE_TTL_MS),
         )
-        if result:
-            self._is_leader = True
-            return True
-
-        current = await r.get(LEADER_KEY)
-        if current and current.decode("utf-8") == self.instance_id:
-            self._is_leader = True
-            return True
+        if not result:
+            self._is_leader = False
+            self.token = None
+            return False
 
-        self._is_leader = False
-        return False
+        token, last_seen, now = result
+        if last_seen >= 0 and not self._is_leader:
+            LEADER_FAILOVER.observe(max(now - last_seen, 0) / 1000)
+        self._is_leader = True
+        self.token = int(token)
+        return True
 
     async def refresh(self) -> bool:
         r = await self._get_redis()
         result = await r.eval(
-            REFRESH_LUA, 1, LEADER_KEY, self.instance_id, str(LEASE_TTL_MS)
+            REFRESH_LUA, 2, LEADER_KEY, LEADER_SEEN, self.instance_id, str(LEASE_TTL_MS)
         )
         if result == 0:
             self._is_leader = False
             return False
         return True
 
+    async def release(self):
+        """Give the lease up so a follower can take over without waiting for it to expire."""
+        r = await self._get_redis()
+        await r.eval(RELEASE_LUA, 2, LEADER_KEY, LEADER_SEEN, self.instance_id)
+        self._is_leader = False
+        self.token = None
+
+    async def wait_for_vacancy(self):
+        """Sleep for FOLLOWER_POLL_MS, or less when the lease expires sooner."""
+        r = await self._get_redis()
+        remaining = await r.pttl(LEADER_KEY)
+        if remaining > 0:
+            await asyncio.sleep(min(remaining, FOLLOWER_POLL_MS) / 1000)
+
     @property
     def is_leader(self) -> bool:
         return self._is_leader
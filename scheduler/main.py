@@ -1,11 +1,32 @@
 import asyncio
 import os
+import redis.asyncio as redis
 from prometheus_client import start_http_server
 from .leader_election import RedisLeaderElection, HEARTBEAT_INTERVAL
-from .job_assigner import run_assignment_loop
-from .recovery import run_recovery_loop
+from .job_assigner import run_assignment_loop, run_reclaim_loop, REDIS_URL
+from .worker_registry import WorkerRegistry
+from .recovery import run_recovery_loop, run_inflight_reconcile_loop
+from .events import run_event_loop
+from .timers import run_timer_loop
+from .membership import run_membership_loop, run_rebalance_loop, take_over
 
 SCHEDULER_CONSUMER = os.getenv("HOSTNAME", "scheduler-1")
+# "leader": only the elected replica assigns jobs; the others are hot spares.
+# "sharded": every replica assigns jobs from the shared consumer group and
+# only recovery, timers, events and rebalancing stay with the leader.
+SCHEDULER_MODE = os.getenv("SCHEDULER_MODE", "leader")
+
+
+def start_leader_tasks(election: RedisLeaderElection, registry: WorkerRegistry) -> list:
+    loops = [
+        run_recovery_loop(), run_event_loop(), run_timer_loop(), run_reclaim_loop(),
+        run_inflight_reconcile_loop(), take_over(SCHEDULER_MODE == "sharded"),
+    ]
+    if SCHEDULER_MODE == "sharded":
+        loops.append(run_rebalance_loop())
+    else:
+        loops.append(run_assignment_loop(election.token, registry))
+    return [asyncio.create_task(loop) for loop in loops]
 
 
 async def main():
@@ -20,17 +41,29 @@ async def main():
         sys.exit(1)
 
     election = RedisLeaderElection(instance_id=SCHEDULER_CONSUMER)
+    r = redis.from_url(REDIS_URL)
+    # Followers keep this fresh so a new leader places its first batch
+    # without a cold round of registry reads.
+    registry = WorkerRegistry(r)
+
+    if SCHEDULER_MODE == "sharded":
+        print(f"Sharded mode: {SCHEDULER_CONSUMER} joins the assignment group", flush=True)
+        # Held for the life of the process; the loops handle their own errors.
+        shared_tasks = [
+            asyncio.create_task(run_membership_loop()),
+            asyncio.create_task(run_assignment_loop(registry=registry)),
+        ]
 
+    following = False
     while True:
         try:
-            print("Attempting to become leader...")
             is_leader = await election.acquire()
 
             if is_leader:
-                print(f"I am the LEADER ({SCHEDULER_CONSUMER}). Starting scheduler loop...")
+                following = False
+                print(f"I am the LEADER ({SCHEDULER_CONSUMER}, token {election.token}). Starting scheduler loop...")
 
-                scheduler_task = asyncio.create_task(run_assignment_loop())
-                reconcile_task = asyncio.create_task(run_recovery_loop())
+                tasks = start_leader_tasks(election, registry)
 
                 try:
                     while True:
@@ -43,20 +76,21 @@ async def main():
                     print(f"Error maintaining leadership: {e}")
                 finally:
                     print("Stopping scheduler loop...")
-                    scheduler_task.cancel()
-                    reconcile_task.cancel()
-                    try:
-                        await scheduler_task
-                        await reconcile_task
-                    except asyncio.CancelledError:
-                        pass
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    await election.release()
             else:
-                print(f"I am a FOLLOWER ({SCHEDULER_CONSUMER}). Leader is active.")
-                await asyncio.sleep(5)
+                if not following:
+                    print(f"I am a FOLLOWER ({SCHEDULER_CONSUMER}). Leader is active.")
+                    following = True
+                if SCHEDULER_MODE != "sharded":
+                    await registry.live_workers()
+                await election.wait_for_vacancy()
 
         except Exception as e:
             print(f"Leader Election Error: {e}")
-            await asyncio.sleep(5)
+            await asyncio.sleep(1)
 
 
 if __name__ == "__main__":
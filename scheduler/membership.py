@@ -0,0 +1,138 @@
+import asyncio
+import os
+import redis.asyncio as redis
+from prometheus_client import Gauge
+from .queues import PRIORITY_STREAMS, ensure_groups, requeue
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+SCHEDULER_MEMBERS = "schedulers:members"
+SCHEDULER_GROUP = "schedulers"
+SCHEDULER_CONSUMER = os.getenv("HOSTNAME", "scheduler-1")
+MEMBER_HEARTBEAT_SECS = float(os.getenv("MEMBER_HEARTBEAT_SECS", "2"))
+MEMBER_TTL_MS = int(os.getenv("MEMBER_TTL_MS", "10000"))
+HANDOFF_BATCH = 500
+
+SCHEDULER_REPLICAS = Gauge("scheduler_replicas", "Scheduler replicas sharing the job streams")
+
+# Score members by Redis server time so replicas never compare clocks.
+JOIN_LUA = """
+local t = redis.call('time')
+redis.call('zadd', KEYS[1], t[1] * 1000 + math.floor(t[2] / 1000), ARGV[1])
+return 1
+"""
+
+
+async def heartbeat(r: redis.Redis, consumer: str = SCHEDULER_CONSUMER):
+    await r.eval(JOIN_LUA, 1, SCHEDULER_MEMBERS, consumer)
+
+
+async def live_members(r: redis.Redis) -> list[str]:
+    secs, usecs = await r.time()
+    cutoff = secs * 1000 + usecs // 1000 - MEMBER_TTL_MS
+    members = await r.zrangebyscore(SCHEDULER_MEMBERS, cutoff, "+inf")
+    return [m.decode("utf-8") for m in members]
+
+
+async def find_departed(r: redis.Redis) -> list[str]:
+    """Replicas whose membership heartbeat is older than MEMBER_TTL_MS."""
+    secs, usecs = await r.time()
+    cutoff = secs * 1000 + usecs // 1000 - MEMBER_TTL_MS
+    departed = await r.zrangebyscore(SCHEDULER_MEMBERS, "-inf", f"({cutoff}")
+    return [m.decode("utf-8") for m in departed]
+
+
+async def hand_off(r: redis.Redis, consumer: str) -> int:
+    """Put a departed replica's unacknowledged jobs back on their streams.
+
+    The consumer group already spreads new entries across whoever is
+    reading; only what the departed replica read but never acknowledged
+    needs moving. Each entry is claimed, re-added as a fresh entry for any
+    live replica to pick up, and acknowledged. A job that was in fact
+    assigned before the replica died is dispatched again to the same
+    worker, which drops the duplicate.
+    """
+    moved = 0
+    for stream in PRIORITY_STREAMS.values():
+        while True:
+            pending = await r.xpending_range(
+                stream, SCHEDULER_GROUP, "-", "+", HANDOFF_BATCH, consumername=consumer
+            )
+            if not pending:
+                break
+            ids = [p["message_id"] for p in pending]
+            claimed = await r.xclaim(stream, SCHEDULER_GROUP, SCHEDULER_CONSUMER, 0, ids)
+            moved += await requeue(r, stream, SCHEDULER_GROUP, claimed, ids)
+
+        try:
+            await r.xgroup_delconsumer(stream, SCHEDULER_GROUP, consumer)
+        except redis.ResponseError as e:
+            if "NOGROUP" not in str(e):
+                raise
+    return moved
+
+
+async def group_consumers(r: redis.Redis) -> set[str]:
+    """Every consumer with an entry in the group on any priority stream."""
+    names = set()
+    for stream in PRIORITY_STREAMS.values():
+        try:
+            consumers = await r.xinfo_consumers(stream, SCHEDULER_GROUP)
+        except redis.ResponseError as e:
+            if "NOGROUP" not in str(e) and "no such key" not in str(e):
+                raise
+            continue
+        for c in consumers:
+            name = c["name"]
+            names.add(name.decode("utf-8") if isinstance(name, bytes) else name)
+    return names
+
+
+async def take_over(sharded: bool):
+    """Leader only, once on election: hand off the pending jobs of every
+    other consumer at once, rather than leaving the previous leader's to
+    the reclaim loop. Live replicas keep theirs in sharded mode."""
+    r = redis.from_url(REDIS_URL)
+    try:
+        await ensure_groups(r, SCHEDULER_GROUP)
+        keep = {SCHEDULER_CONSUMER}
+        if sharded:
+            keep.update(await live_members(r))
+        for consumer in await group_consumers(r) - keep:
+            moved = await hand_off(r, consumer)
+            print(f"Took over from {consumer}: handed off {moved} pending jobs")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Take-over hand-off error: {e}")
+
+
+async def run_membership_loop():
+    """Keep this replica in the membership set while it shares the stream."""
+    r = redis.from_url(REDIS_URL)
+    while True:
+        try:
+            await heartbeat(r)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Membership heartbeat error: {e}")
+        await asyncio.sleep(MEMBER_HEARTBEAT_SECS)
+
+
+async def run_rebalance_loop():
+    """Leader only: hand off the pending work of replicas that left."""
+    print("Rebalance loop started...")
+    r = redis.from_url(REDIS_URL)
+    while True:
+        try:
+            for consumer in await find_departed(r):
+                moved = await hand_off(r, consumer)
+                await r.zrem(SCHEDULER_MEMBERS, consumer)
+                print(f"Scheduler {consumer} left: handed off {moved} pending jobs")
+            SCHEDULER_REPLICAS.set(len(await live_members(r)))
+            await asyncio.sleep(MEMBER_HEARTBEAT_SECS)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Rebalance loop error: {e}")
+            await asyncio.sleep(5)
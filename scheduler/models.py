@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, DateTime, Enum as SAEnum, Integer, Text
+from sqlalchemy import Column, String, DateTime, Enum as SAEnum, Integer, Float, Text, Index
 from sqlalchemy.dialects.postgresql import UUID, JSONB
 import uuid
 from datetime import datetime, timezone
@@ -7,6 +7,8 @@ from .database import Base
 
 
 class JobStatus(str, enum.Enum):
+    SCHEDULED = "SCHEDULED"
+    BLOCKED = "BLOCKED"
     PENDING = "PENDING"
     ASSIGNED = "ASSIGNED"
     PULLING = "PULLING"
@@ -21,14 +23,34 @@ class JobStatus(str, enum.Enum):
 
 class Job(Base):
     __tablename__ = "jobs"
+    __table_args__ = (
+        # Recovery looks up a dead worker's active jobs through this index.
+        Index("ix_jobs_assigned_worker_status", "assigned_worker", "status"),
+        Index("ix_jobs_array_id", "array_id"),
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     status = Column(SAEnum(JobStatus), default=JobStatus.PENDING, nullable=False)
     command = Column(JSONB, nullable=True)
     image_base = Column(String, default="python:3.11-slim")
     assigned_worker = Column(String, nullable=True)
+    env_key = Column(String, nullable=True)
+    priority = Column(String, default="normal", nullable=False)
+    tenant = Column(String, default="default", nullable=False)
+    depends_on = Column(JSONB, nullable=True)
+    run_at = Column(DateTime(timezone=True), nullable=True)
+    cron = Column(String, nullable=True)
+    # Tasks of a job array share one bundle (``manifest`` names it) and differ
+    # by array_index and their arguments in ``command``.
+    array_id = Column(UUID(as_uuid=True), nullable=True)
+    array_index = Column(Integer, nullable=True)
+    # Run settings and the digest of the packed bundle; older jobs keep
+    # their manifest in MinIO instead.
+    manifest = Column(JSONB, nullable=True)
 
     retries_left = Column(Integer, default=3, nullable=False)
+    max_retries = Column(Integer, default=3, nullable=False)
+    retry_backoff_secs = Column(Float, default=1.0, nullable=False)
     timeout_secs = Column(Integer, default=300, nullable=False)
 
     exit_code = Column(Integer, nullable=True)
@@ -39,3 +61,11 @@ class Job(Base):
     updated_at = Column(DateTime(timezone=True), default=lambda: datetime.now(timezone.utc), onupdate=lambda: datetime.now(timezone.utc))
     started_at = Column(DateTime(timezone=True), nullable=True)
     finished_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class SchedulerFence(Base):
+    """Highest leader fencing token seen by the database."""
+    __tablename__ = "scheduler_fence"
+
+    name = Column(String, primary_key=True)
+    token = Column(Integer, nullable=False)
@@ -0,0 +1,96 @@
+import os
+import random
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+PLACEMENT_STRATEGY = os.getenv("PLACEMENT_STRATEGY", "least_loaded")
+ENV_AFFINITY_WEIGHT = float(os.getenv("ENV_AFFINITY_WEIGHT", "0.5"))
+
+
+@dataclass
+class WorkerState:
+    """Capacity a worker advertises: total job slots, how many are busy,
+    which environment images it already has cached and, as of its last
+    heartbeat, how much of its CPU and memory budget running jobs hold."""
+
+    worker_id: str
+    slots: int = 1
+    in_use: int = 0
+    envs: frozenset = frozenset()
+    cpus: float = 0.0
+    cpus_in_use: float = 0.0
+    mem_mb: int = 0
+    mem_mb_in_use: int = 0
+
+    @property
+    def free(self) -> int:
+        return max(self.slots - self.in_use, 0)
+
+    @property
+    def load(self) -> float:
+        """The busiest of the worker's slots, CPU and memory, as a fraction."""
+        if self.slots <= 0:
+            return 1.0
+        load = self.in_use / self.slots
+        if self.cpus > 0:
+            load = max(load, self.cpus_in_use / self.cpus)
+        if self.mem_mb > 0:
+            load = max(load, self.mem_mb_in_use / self.mem_mb)
+        return load
+
+    def score(self, env_key: str = None) -> float:
+        """Effective load: a worker already holding the job's environment is
+        discounted by ENV_AFFINITY_WEIGHT, trading a little balance for
+        skipping an image build."""
+        if env_key and env_key in self.envs:
+            return self.load - ENV_AFFINITY_WEIGHT
+        return self.load
+
+
+def first_available(workers: list[WorkerState], env_key: str = None) -> Optional[WorkerState]:
+    """Pick the first worker with a free slot (previous behaviour)."""
+    for w in workers:
+        if w.free > 0:
+            return w
+    return None
+
+
+def least_loaded(workers: list[WorkerState], env_key: str = None) -> Optional[WorkerState]:
+    """Pick the worker with the lowest effective load, most free slots on ties."""
+    candidates = [w for w in workers if w.free > 0]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda w: (w.score(env_key), -w.free))
+
+
+def power_of_two(workers: list[WorkerState], env_key: str = None) -> Optional[WorkerState]:
+    """Sample two workers with free slots and keep the less loaded one.
+
+    When some workers hold the job's environment, one of the two samples is
+    drawn from them so affinity is not left to chance.
+    """
+    candidates = [w for w in workers if w.free > 0]
+    if len(candidates) <= 2:
+        return least_loaded(candidates, env_key)
+    warm = [w for w in candidates if env_key and env_key in w.envs]
+    if warm:
+        first = random.choice(warm)
+        second = random.choice([w for w in candidates if w is not first])
+        return least_loaded([first, second], env_key)
+    return least_loaded(random.sample(candidates, 2), env_key)
+
+
+Strategy = Callable[[list[WorkerState], Optional[str]], Optional[WorkerState]]
+
+STRATEGIES: dict[str, Strategy] = {
+    "first": first_available,
+    "least_loaded": least_loaded,
+    "power_of_two": power_of_two,
+}
+
+
+def get_strategy(name: str = None) -> Strategy:
+    name = name or PLACEMENT_STRATEGY
+    if name not in STRATEGIES:
+        raise ValueError(f"Unknown placement strategy {name!r}; choose from {sorted(STRATEGIES)}")
+    return STRATEGIES[name]
@@ -0,0 +1,162 @@
+import os
+import redis.asyncio as redis
+from typing import Optional
+
+PRIORITIES = ("high", "normal", "low")
+DEFAULT_PRIORITY = "normal"
+PRIORITY_STREAMS = {
+    "high": "jobs:pending:high",
+    "normal": "jobs:pending",
+    "low": "jobs:pending:low",
+}
+# Jobs per tenant that were accepted and have not finished; the API's
+# admission control reads it, the event loop decrements it.
+TENANT_INFLIGHT = "tenants:inflight"
+
+
+def _parse_weights(spec: str) -> dict[str, int]:
+    weights = {"high": 8, "normal": 3, "low": 1}
+    for part in filter(None, spec.split(",")):
+        name, _, value = part.partition("=")
+        if name.strip() in weights:
+            weights[name.strip()] = max(int(value), 1)
+    return weights
+
+
+PRIORITY_WEIGHTS = _parse_weights(os.getenv("PRIORITY_WEIGHTS", ""))
+
+
+def stream_for(priority: str) -> str:
+    return PRIORITY_STREAMS.get(priority, PRIORITY_STREAMS[DEFAULT_PRIORITY])
+
+
+def stream_entry(job_id: str, env_key: str = None) -> dict:
+    fields = {"job_id": job_id}
+    if env_key:
+        fields["env_key"] = env_key
+    return fields
+
+
+def _shares(total: int, classes: list[str]) -> dict[str, int]:
+    """Split ``total`` reads across ``classes`` (highest priority first) by
+    weight, never more than ``total`` in all.
+
+    What rounding down leaves goes one read at a time to the classes that
+    got none, then to the rest, each in priority order, so a small ``total``
+    is spent on the highest classes first.
+    """
+    weight_sum = sum(PRIORITY_WEIGHTS[p] for p in classes)
+    shares = {p: total * PRIORITY_WEIGHTS[p] // weight_sum for p in classes}
+    left = total - sum(shares.values())
+    for p in sorted(classes, key=lambda p: shares[p] > 0)[:left]:
+        shares[p] += 1
+    return shares
+
+
+async def ensure_groups(r: redis.Redis, group: str):
+    """Create ``group`` on every priority stream that does not have it yet."""
+    for stream in PRIORITY_STREAMS.values():
+        try:
+            await r.xgroup_create(stream, group, id="0", mkstream=True)
+            print(f"Created consumer group {group} on {stream}")
+        except redis.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+
+async def _read_shares(r: redis.Redis, group: str, consumer: str, shares: dict[str, int]) -> dict[str, list]:
+    # COUNT 0 would mean no limit at all.
+    shares = {p: count for p, count in shares.items() if count > 0}
+    async with r.pipeline(transaction=False) as pipe:
+        for p, count in shares.items():
+            pipe.xreadgroup(group, consumer, {PRIORITY_STREAMS[p]: ">"}, count=count)
+        results = await pipe.execute(raise_on_error=False)
+
+    got = {p: [] for p in PRIORITIES}
+    for p, res in zip(shares, results):
+        if isinstance(res, redis.ResponseError):
+            if "NOGROUP" not in str(res):
+                raise res
+            # The stream was deleted or trimmed away; recreate and move on.
+            await ensure_groups(r, group)
+            res = None
+        got[p] = res[0][1] if res else []
+    return got
+
+
+async def read_weighted(
+    r: redis.Redis, group: str, consumer: str, batch_size: int, block_ms: Optional[int]
+) -> list[tuple[str, bytes, dict]]:
+    """Weighted fair dequeue across the priority streams.
+
+    Each class gets a share of the batch proportional to its weight, so a
+    backlog of low-priority work cannot delay high-priority jobs by more than
+    one batch. Shares left unused by idle classes go to the busy ones, and
+    only when every stream is empty do we block (unless ``block_ms`` is
+    None). Returns
+    ``(stream, message_id, fields)`` tuples, highest priority first.
+    """
+    shares = _shares(batch_size, list(PRIORITIES))
+    got = await _read_shares(r, group, consumer, shares)
+
+    leftover = batch_size - sum(len(msgs) for msgs in got.values())
+    backlogged = [p for p in PRIORITIES if len(got[p]) == shares[p]]
+    if leftover > 0 and backlogged:
+        extra = await _read_shares(r, group, consumer, _shares(leftover, backlogged))
+        for p, msgs in extra.items():
+            got[p].extend(msgs)
+
+    if not any(got.values()) and block_ms is not None:
+        streams = await r.xreadgroup(
+            group,
+            consumer,
+            {PRIORITY_STREAMS[p]: ">" for p in PRIORITIES},
+            count=batch_size,
+            block=block_ms,
+        )
+        by_stream = {s.decode("utf-8"): msgs for s, msgs in streams or []}
+        got = {p: by_stream.get(PRIORITY_STREAMS[p], []) for p in PRIORITIES}
+
+    return [
+        (PRIORITY_STREAMS[p], message_id, data)
+        for p in PRIORITIES
+        for message_id, data in got[p]
+    ]
+
+
+async def requeue(r: redis.Redis, stream: str, group: str, entries: list, message_ids: list) -> int:
+    """Add claimed ``entries`` back to ``stream`` as new entries and ack the originals.
+
+    Any consumer in the group can then pick them up. Entries trimmed from
+    the stream come back without fields and are only acknowledged.
+    """
+    moved = 0
+    async with r.pipeline(transaction=False) as pipe:
+        for _, data in entries:
+            if data:
+                pipe.xadd(stream, data)
+                moved += 1
+        pipe.xack(stream, group, *message_ids)
+        await pipe.execute()
+    return moved
+
+
+async def reclaim_idle(r: redis.Redis, group: str, consumer: str, min_idle_ms: int, count: int = 500) -> int:
+    """Requeue entries that have sat unacknowledged in ``group`` for at least
+    ``min_idle_ms``, whichever consumer read them."""
+    moved = 0
+    for stream in PRIORITY_STREAMS.values():
+        start = "0-0"
+        while True:
+            try:
+                result = await r.xautoclaim(stream, group, consumer, min_idle_ms, start, count=count)
+            except redis.ResponseError as e:
+                if "NOGROUP" not in str(e):
+                    raise
+                break
+            start, claimed = result[0], result[1]
+            if claimed:
+                moved += await requeue(r, stream, group, claimed, [m for m, _ in claimed])
+            if start in (b"0-0", "0-0"):
+                break
+    return moved
@@ -1,90 +1,204 @@
 import asyncio
 import os
+import time
+import uuid
 from datetime import datetime, timezone
 import redis.asyncio as redis
+from prometheus_client import Histogram
+from sqlalchemy import func, update
 from sqlalchemy.future import select
 from .database import get_db_session
 from .models import Job, JobStatus
+from .queues import stream_for, stream_entry, TENANT_INFLIGHT
+from .events import queue_event
+from .retries import schedule_retries
+from .worker_registry import find_dead_workers, forget_workers
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
-JOBS_STREAM = "jobs:pending"
-WORKERS_SET = "available_workers"
+RECOVERY_INTERVAL_SECS = int(os.getenv("RECOVERY_INTERVAL_SECS", "30"))
+RECOVERY_PAGE_SIZE = int(os.getenv("RECOVERY_PAGE_SIZE", "1000"))
+INFLIGHT_RECONCILE_SECS = int(os.getenv("INFLIGHT_RECONCILE_SECS", "300"))
 
+ACTIVE_STATES = [
+    JobStatus.ASSIGNED,
+    JobStatus.PULLING,
+    JobStatus.INSTALLING,
+    JobStatus.RUNNING,
+]
 
-async def run_recovery_loop(interval: int = 30):
-    """Detect stuck jobs on dead workers and re-enqueue them."""
+# Everything admission control counts against a tenant.
+INFLIGHT_STATES = [
+    s for s in JobStatus if s not in (JobStatus.SUCCESS, JobStatus.DEAD, JobStatus.CANCELED)
+]
+
+RECOVERY_PASS_DURATION = Histogram(
+    "recovery_pass_duration_seconds", "Time taken by one recovery pass"
+)
+
+
+async def _recover_page(r: redis.Redis, worker_id: str, after: uuid.UUID = None):
+    """Requeue (or bury) one page of a dead worker's active jobs.
+
+    Returns the last job id seen and how many jobs were recovered. Both
+    UPDATEs keep the assignment guard, so a job the worker finished in the
+    meantime is left alone.
+
+    The stream entries and DEAD events are written before the transaction
+    commits: if Redis fails the page rolls back and the next pass finds the
+    jobs again. An entry read before the commit waits on the row lock in
+    ``assign_jobs``; one left by a failed commit finds the job still
+    assigned to the dead worker, and the next pass requeues it again.
+    """
+    query = select(Job.id).where(
+        Job.assigned_worker == worker_id, Job.status.in_(ACTIVE_STATES)
+    )
+    if after is not None:
+        query = query.where(Job.id > after)
+    query = query.order_by(Job.id).limit(RECOVERY_PAGE_SIZE)
+
+    async_session = get_db_session()
+    async for session in async_session:
+        try:
+            page = (await session.execute(query)).scalars().all()
+            if not page:
+                return None, 0
+
+            guard = (
+                Job.id.in_(page),
+                Job.assigned_worker == worker_id,
+                Job.status.in_(ACTIVE_STATES),
+            )
+            requeued = (await session.execute(
+                update(Job)
+                .where(*guard, Job.retries_left > 0)
+                .values(
+                    status=JobStatus.PENDING,
+                    assigned_worker=None,
+                    retries_left=Job.retries_left - 1,
+                    updated_at=datetime.now(timezone.utc),
+                )
+                .returning(Job.id, Job.priority, Job.env_key)
+                .execution_options(synchronize_session=False)
+            )).all()
+            dead = (await session.execute(
+                update(Job)
+                .where(*guard, Job.retries_left <= 0)
+                .values(
+                    status=JobStatus.DEAD,
+                    error_message="Retries exhausted after worker failure",
+                    updated_at=datetime.now(timezone.utc),
+                )
+                .returning(Job.id, Job.tenant)
+                .execution_options(synchronize_session=False)
+            )).all()
+
+            async with r.pipeline(transaction=False) as pipe:
+                for job_id, priority, env_key in requeued:
+                    pipe.xadd(stream_for(priority), stream_entry(str(job_id), env_key))
+                for job_id, tenant in dead:
+                    queue_event(pipe, str(job_id), JobStatus.DEAD.value, tenant=tenant)
+                await pipe.execute()
+            await session.commit()
+            return page[-1], len(requeued) + len(dead)
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
+    return None, 0
+
+
+async def recover_worker(r: redis.Redis, worker_id: str) -> int:
+    """Requeue every active job of a dead worker, a page at a time."""
+    recovered, after = 0, None
+    while True:
+        after, count = await _recover_page(r, worker_id, after)
+        if after is None:
+            break
+        recovered += count
+
+    if recovered:
+        print(f"Worker {worker_id} is DEAD. Recovered {recovered} jobs")
+    return recovered
+
+
+async def run_recovery_pass(r: redis.Redis, interval: int):
+    dead_workers = await find_dead_workers(r)
+    for worker_id in dead_workers:
+        await recover_worker(r, worker_id)
+    # Only forget workers once their jobs are safely requeued, so a crash
+    # mid-pass finds them again next time.
+    if dead_workers:
+        await forget_workers(r, dead_workers)
+
+    # Failures are normally retried straight from the worker's event;
+    # this only catches jobs whose event was lost.
+    await schedule_retries(r, older_than=interval)
+
+
+async def run_recovery_loop(interval: int = RECOVERY_INTERVAL_SECS):
+    """Requeue the jobs of workers whose heartbeat expired, and retry failed
+    jobs whose completion event never reached the event loop."""
     print("Recovery loop started...")
     r = redis.from_url(REDIS_URL)
 
     while True:
         try:
             await asyncio.sleep(interval)
-            print("Running recovery check...")
-
-            async_session = get_db_session()
-            async for session in async_session:
-                try:
-                    active_states = [
-                        JobStatus.ASSIGNED,
-                        JobStatus.PULLING,
-                        JobStatus.INSTALLING,
-                        JobStatus.RUNNING,
-                    ]
-                    result = await session.execute(
-                        select(Job).where(Job.status.in_(active_states))
-                    )
-                    active_jobs = result.scalars().all()
-
-                    for job in active_jobs:
-                        if not job.assigned_worker:
-                            continue
-
-                        hb_key = f"worker:heartbeat:{job.assigned_worker}"
-                        is_alive = await r.exists(hb_key)
-
-                        if not is_alive:
-                            print(f"Worker {job.assigned_worker} is DEAD. Re-enqueuing job {job.id}")
-                            await r.srem(WORKERS_SET, job.assigned_worker)
-
-                            if job.retries_left > 0:
-                                job.status = JobStatus.PENDING
-                                job.assigned_worker = None
-                                job.retries_left -= 1
-                                job.updated_at = datetime.now(timezone.utc)
-                                await session.commit()
-                                await r.xadd(JOBS_STREAM, {"job_id": str(job.id)})
-                            else:
-                                job.status = JobStatus.DEAD
-                                job.error_message = "Retries exhausted after worker failure"
-                                job.updated_at = datetime.now(timezone.utc)
-                                await session.commit()
-
-                    result = await session.execute(
-                        select(Job).where(
-                            Job.status == JobStatus.FAILED,
-                            Job.retries_left > 0,
-                        )
-                    )
-                    failed_jobs = result.scalars().all()
-
-                    for job in failed_jobs:
-                        print(f"Retrying failed job {job.id} (retries_left={job.retries_left})")
-                        job.status = JobStatus.PENDING
-                        job.retries_left -= 1
-                        job.assigned_worker = None
-                        job.updated_at = datetime.now(timezone.utc)
-                        await session.commit()
-                        await r.xadd(JOBS_STREAM, {"job_id": str(job.id)})
-
-                except Exception as e:
-                    print(f"Recovery error DB: {e}")
-                    await session.rollback()
-                finally:
-                    await session.close()
-                break
+            started = time.monotonic()
+            await run_recovery_pass(r, interval)
+            RECOVERY_PASS_DURATION.observe(time.monotonic() - started)
 
         except asyncio.CancelledError:
             raise
         except Exception as e:
             print(f"Recovery loop error: {e}")
             await asyncio.sleep(5)
+
+
+async def reconcile_inflight(r: redis.Redis) -> dict[str, int]:
+    """Rebuild the per-tenant inflight counts from the database.
+
+    The counts are kept by increments on submission and decrements on
+    events, so a lost event or a job stranded mid-run leaves them wrong
+    until this pass. Changes made between the query and the write are
+    overwritten and corrected by the next pass.
+    """
+    async_session = get_db_session()
+    async for session in async_session:
+        try:
+            result = await session.execute(
+                select(Job.tenant, func.count())
+                .where(Job.status.in_(INFLIGHT_STATES))
+                .group_by(Job.tenant)
+            )
+            counts = dict(result.all())
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
+
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.delete(TENANT_INFLIGHT)
+        if counts:
+            pipe.hset(TENANT_INFLIGHT, mapping=counts)
+        await pipe.execute()
+    return counts
+
+
+async def run_inflight_reconcile_loop(interval: int = INFLIGHT_RECONCILE_SECS):
+    """Leader only: periodically rebuild ``tenants:inflight`` from the jobs table."""
+    print("Inflight reconcile loop started...")
+    r = redis.from_url(REDIS_URL)
+
+    while True:
+        try:
+            counts = await reconcile_inflight(r)
+            print(f"Reconciled inflight counts for {len(counts)} tenants")
+            await asyncio.sleep(interval)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Inflight reconcile error: {e}")
+            await asyncio.sleep(5)
@@ -0,0 +1,99 @@
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+import redis.asyncio as redis
+from sqlalchemy import func, select, update
+from .database import get_db_session
+from .models import Job, JobStatus
+from .timers import DELAYED_JOBS
+
+RETRY_BACKOFF_MAX_SECS = float(os.getenv("RETRY_BACKOFF_MAX_SECS", "300"))
+
+
+async def schedule_retries(r: redis.Redis, job_ids: list[str] = None, older_than: float = None) -> int:
+    """Move FAILED jobs with retries left to RETRYING and park them in the
+    delay queue.
+
+    The delay is the job's ``retry_backoff_secs`` doubled for every retry
+    already spent, capped at RETRY_BACKOFF_MAX_SECS, with equal jitter so a
+    batch of jobs failing together does not come back together. The status
+    guard makes concurrent callers (event loop and recovery sweep) safe.
+    Pass ``job_ids`` for specific jobs, or ``older_than`` (seconds) to sweep
+    every FAILED job that has not been picked up that long.
+
+    RETRYING is committed before the delay queue is written, so matching
+    jobs already RETRYING are parked again at their stored ``run_at``
+    (ZADD NX, harmless if they are there); otherwise a failed ZADD would
+    leave them RETRYING for good.
+    """
+    backoff = func.least(
+        Job.retry_backoff_secs * func.power(2, Job.max_retries - Job.retries_left),
+        RETRY_BACKOFF_MAX_SECS,
+    ) * (0.5 + func.random() * 0.5)
+
+    stmt = update(Job).where(Job.status == JobStatus.FAILED, Job.retries_left > 0)
+    parked = select(Job.id, Job.run_at).where(Job.status == JobStatus.RETRYING, Job.run_at.isnot(None))
+    if job_ids is not None:
+        ids = [uuid.UUID(j) for j in job_ids]
+        stmt = stmt.where(Job.id.in_(ids))
+        parked = parked.where(Job.id.in_(ids))
+    if older_than is not None:
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=older_than)
+        stmt = stmt.where(Job.updated_at < cutoff)
+        parked = parked.where(Job.updated_at < cutoff)
+
+    async_session = get_db_session()
+    async for session in async_session:
+        try:
+            stranded = (await session.execute(parked)).all()
+            result = await session.execute(
+                stmt.values(
+                    status=JobStatus.RETRYING,
+                    retries_left=Job.retries_left - 1,
+                    assigned_worker=None,
+                    run_at=func.now() + func.make_interval(0, 0, 0, 0, 0, 0, backoff),
+                    updated_at=datetime.now(timezone.utc),
+                )
+                .returning(Job.id, Job.run_at)
+                .execution_options(synchronize_session=False)
+            )
+            retrying = result.all()
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
+
+    if stranded:
+        await r.zadd(DELAYED_JOBS, {str(job_id): run_at.timestamp() for job_id, run_at in stranded}, nx=True)
+    if retrying:
+        await r.zadd(DELAYED_JOBS, {str(job_id): run_at.timestamp() for job_id, run_at in retrying})
+        for job_id, run_at in retrying:
+            print(f"Retrying job {job_id} at {run_at.isoformat()}")
+    return len(retrying)
+
+
+async def mark_exhausted(job_id: str) -> bool:
+    """FAILED with no retries left becomes DEAD."""
+    async_session = get_db_session()
+    async for session in async_session:
+        try:
+            result = await session.execute(
+                update(Job)
+                .where(
+                    Job.id == uuid.UUID(job_id),
+                    Job.status == JobStatus.FAILED,
+                    Job.retries_left <= 0,
+                )
+                .values(status=JobStatus.DEAD, updated_at=datetime.now(timezone.utc))
+                .execution_options(synchronize_session=False)
+            )
+            await session.commit()
+            return result.rowcount > 0
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
+    return False
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+import redis.asyncio as redis
+from croniter import croniter
+from sqlalchemy import select, update
+from .database import get_db_session
+from .models import Job, JobStatus
+from .queues import stream_for, stream_entry
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
+DELAYED_JOBS = "jobs:delayed"
+TIMER_TICK_SECS = float(os.getenv("TIMER_TICK_SECS", "0.25"))
+TIMER_RELEASE_RATE = float(os.getenv("TIMER_RELEASE_RATE", "200"))
+TIMER_JITTER_SECS = float(os.getenv("TIMER_JITTER_SECS", "5"))
+
+
+def next_cron_fire(cron: str, after: datetime = None) -> datetime:
+    """Next fire time of ``cron``, spread by up to TIMER_JITTER_SECS so
+    schedules sharing an expression do not all land on the same second."""
+    after = after or datetime.now(timezone.utc)
+    fire = croniter(cron, after).get_next(datetime)
+    return datetime.fromtimestamp(fire.timestamp() + random.uniform(0, TIMER_JITTER_SECS), timezone.utc)
+
+
+async def release_due(r: redis.Redis, limit: int) -> int:
+    """Move up to ``limit`` due delayed, cron and retrying jobs from the
+    delay queue into their streams.
+
+    Entries are removed from the sorted set only after the jobs are enqueued.
+    A job an earlier pass made PENDING but never enqueued (a crash or a
+    failed pipeline in between) is still in the set and is enqueued again;
+    a duplicate entry is weeded out by ``assign_jobs`` and the worker.
+    """
+    due = await r.zrangebyscore(DELAYED_JOBS, "-inf", time.time(), start=0, num=limit)
+    if not due:
+        return 0
+
+    job_ids = [uuid.UUID(d.decode("utf-8")) for d in due]
+    async_session = get_db_session()
+    async for session in async_session:
+        try:
+            result = await session.execute(
+                update(Job)
+                .where(
+                    Job.id.in_(job_ids),
+                    Job.status.in_([JobStatus.SCHEDULED, JobStatus.RETRYING, JobStatus.PENDING]),
+                )
+                .values(status=JobStatus.PENDING, updated_at=datetime.now(timezone.utc))
+                .returning(Job.id, Job.priority, Job.env_key)
+                .execution_options(synchronize_session=False)
+            )
+            released = result.all()
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
+
+    async with r.pipeline(transaction=False) as pipe:
+        for job_id, priority, env_key in released:
+            pipe.xadd(stream_for(priority), stream_entry(str(job_id), env_key))
+        pipe.zrem(DELAYED_JOBS, *due)
+        await pipe.execute()
+    return len(released)
+
+
+async def rearm_cron(r: redis.Redis, job_id: str) -> bool:
+    """Schedule the next run of a recurring job once the current run is over.
+
+    Returns False for jobs that do not recur.
+    """
+    async_session = get_db_session()
+    async for session in async_session:
+        try:
+            result = await session.execute(select(Job).where(Job.id == uuid.UUID(job_id)))
+            job = result.scalar_one_or_none()
+            if not job or not job.cron:
+                return False
+
+            job.run_at = next_cron_fire(job.cron)
+            job.status = JobStatus.SCHEDULED
+            job.assigned_worker = None
+            job.retries_left = job.max_retries
+            job.updated_at = datetime.now(timezone.utc)
+            await session.commit()
+            await r.zadd(DELAYED_JOBS, {job_id: job.run_at.timestamp()})
+            print(f"Cron job {job_id} next runs at {job.run_at.isoformat()}")
+            return True
+        except Exception:
+            await session.rollback()
+            raise
+        finally:
+            await session.close()
+    return False
+
+
+async def run_timer_loop():
+    """Release delayed and cron jobs as they come due, at most
+    TIMER_RELEASE_RATE per second so a burst of fires is smoothed out."""
+    print("Timer loop started...")
+    r = redis.from_url(REDIS_URL)
+    tokens, last = TIMER_RELEASE_RATE, time.monotonic()
+
+    while True:
+        try:
+            now = time.monotonic()
+            tokens = min(TIMER_RELEASE_RATE, tokens + (now - last) * TIMER_RELEASE_RATE)
+            last = now
+            if tokens >= 1:
+                tokens -= await release_due(r, int(tokens))
+            await asyncio.sleep(TIMER_TICK_SECS)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Timer loop error: {e}")
+            await asyncio.sleep(1)
@@ -0,0 +1,113 @@
+import json
+import os
+import time
+import redis.asyncio as redis
+from .placement import WorkerState
+
+WORKER_HEARTBEATS = "workers:heartbeats"
+WORKER_SLOTS = "workers:slots"
+WORKER_IN_USE = "workers:in_use"
+WORKER_ENVS = "workers:envs"
+WORKER_USAGE = "workers:usage"
+WORKER_CAPACITY = "workers:capacity"
+WORKER_TTL_MS = int(os.getenv("WORKER_TTL_MS", "15000"))
+REGISTRY_REFRESH_SECS = float(os.getenv("REGISTRY_REFRESH_SECS", "0.5"))
+
+
+class WorkerRegistry:
+    """Cached view of fleet liveness, capacity and cached environments.
+
+    Workers write their last heartbeat (scored by Redis server time) into a
+    sorted set and their slot counts, environment tags and CPU / memory use
+    into hashes, so the whole fleet is read back with a single pipelined
+    round trip.
+    """
+
+    def __init__(self, r: redis.Redis, refresh_secs: float = None):
+        self._r = r
+        self.refresh_secs = REGISTRY_REFRESH_SECS if refresh_secs is None else refresh_secs
+        self._workers: dict[str, WorkerState] = {}
+        self._fetched_at = 0.0
+
+    async def live_workers(self, force: bool = False) -> list[WorkerState]:
+        if force or time.monotonic() - self._fetched_at >= self.refresh_secs:
+            await self.refresh()
+        return list(self._workers.values())
+
+    async def refresh(self):
+        async with self._r.pipeline(transaction=False) as pipe:
+            pipe.time()
+            pipe.zrange(WORKER_HEARTBEATS, 0, -1, withscores=True)
+            pipe.hgetall(WORKER_SLOTS)
+            pipe.hgetall(WORKER_IN_USE)
+            pipe.hgetall(WORKER_ENVS)
+            pipe.hgetall(WORKER_USAGE)
+            (secs, usecs), heartbeats, slots, in_use, envs, usage = await pipe.execute()
+
+        cutoff = secs * 1000 + usecs // 1000 - WORKER_TTL_MS
+        workers = {}
+        for w_bytes, last_seen in heartbeats:
+            # Expired entries stay until recovery has requeued their jobs.
+            if last_seen < cutoff:
+                continue
+            w_id = w_bytes.decode("utf-8")
+            pool = json.loads(usage.get(w_bytes, b"{}"))
+            workers[w_id] = WorkerState(
+                w_id,
+                slots=int(slots.get(w_bytes, 1)),
+                in_use=int(in_use.get(w_bytes, 0)),
+                envs=frozenset(json.loads(envs.get(w_bytes, b"[]"))),
+                cpus=float(pool.get("cpus", 0)),
+                cpus_in_use=float(pool.get("cpus_in_use", 0)),
+                mem_mb=int(pool.get("mem_mb", 0)),
+                mem_mb_in_use=int(pool.get("mem_mb_in_use", 0)),
+            )
+
+        self._workers = workers
+        self._fetched_at = time.monotonic()
+
+    def count_assignment(self, pipe, worker_id: str):
+        """Queue the shared busy-slot update on ``pipe`` so it rides along with the dispatch."""
+        pipe.hincrby(WORKER_IN_USE, worker_id, 1)
+
+
+class CapacitySignal:
+    """Wakes the assignment loop when a worker frees a slot or joins.
+
+    Workers publish on ``workers:capacity``; notifications that arrive while
+    the loop is busy wait on the connection, so none are missed between
+    waits.
+    """
+
+    def __init__(self, r: redis.Redis):
+        self._pubsub = r.pubsub(ignore_subscribe_messages=True)
+
+    async def start(self):
+        await self._pubsub.subscribe(WORKER_CAPACITY)
+
+    async def wait(self, timeout: float) -> bool:
+        """Wait up to ``timeout`` seconds for capacity; True if any was signalled."""
+        signalled = await self._pubsub.get_message(timeout=timeout) is not None
+        while await self._pubsub.get_message(timeout=0):
+            signalled = True
+        return signalled
+
+
+async def find_dead_workers(r: redis.Redis) -> list[str]:
+    """Workers whose last heartbeat is older than WORKER_TTL_MS."""
+    secs, usecs = await r.time()
+    cutoff = secs * 1000 + usecs // 1000 - WORKER_TTL_MS
+    dead = await r.zrangebyscore(WORKER_HEARTBEATS, "-inf", f"({cutoff}")
+    return [w.decode("utf-8") for w in dead]
+
+
+async def forget_workers(r: redis.Redis, worker_ids: list[str]):
+    """Drop dead workers from the registry along with their dispatch streams."""
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.zrem(WORKER_HEARTBEATS, *worker_ids)
+        pipe.hdel(WORKER_SLOTS, *worker_ids)
+        pipe.hdel(WORKER_IN_USE, *worker_ids)
+        pipe.hdel(WORKER_ENVS, *worker_ids)
+        pipe.hdel(WORKER_USAGE, *worker_ids)
+        pipe.delete(*[f"worker:{w}:dispatch" for w in worker_ids])
+        await pipe.execute()
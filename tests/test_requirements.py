@@ -0,0 +1,68 @@
+"""The API and the worker must agree on an environment's cache key.
+
+The API computes it at upload for scheduler affinity, the worker when it
+builds the image; each service ships its own copy of the normalisation.
+"""
+from unittest import mock
+
+import docker
+import pytest
+
+from api.services.environments import canonical_requirements as api_canonical
+from api.services.environments import env_key_for_hash, requirements_hash
+
+# The worker module connects to Docker on import.
+with mock.patch.object(docker, "from_env"):
+    from worker.env_resolver import canonical_requirements as worker_canonical
+    from worker.env_resolver import compute_cache_key
+
+SAMPLES = [
+    "",
+    "# only a comment\n\n",
+    "numpy==1.26.4\npandas>=2.0\n",
+    "Pandas >= 2.0 , <3\nnumpy == 1.26.4  # pinned\n",
+    "requests[socks,security]==2.31.0\n",
+    "scikit_learn==1.4.0; python_version >= '3.9'\n",
+    "mypkg @ https://example.com/mypkg-1.0.tar.gz\n",
+    "--index-url https://pypi.example.com/simple\nnumpy==1.26.4\n",
+    "numpy==1.26.4 \\\n    --hash=sha256:aaa \\\n    --hash=sha256:bbb\n",
+    "numpy==1.26.4 --hash sha256:bbb --hash=sha256:aaa\n",
+]
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+def test_api_and_worker_agree(text):
+    assert api_canonical(text) == worker_canonical(text)
+    lines = worker_canonical(text)
+    expected = compute_cache_key("python:3.11-slim", lines) if lines else None
+    assert env_key_for_hash("python:3.11-slim", requirements_hash(text.encode())) == expected
+
+
+def test_formatting_does_not_change_the_key():
+    a = "numpy==1.26.4\nPandas>=2.0,<3\n"
+    b = "# deps\npandas < 3 , >= 2.0\n\nnumpy == 1.26.4   # pinned\n"
+    assert requirements_hash(a.encode()) == requirements_hash(b.encode())
+
+
+def test_names_and_extras_are_normalised():
+    assert worker_canonical("Scikit_Learn.Extra[B, a]>=1") == ["scikit-learn-extra[a,b]>=1"]
+
+
+def test_marker_is_kept():
+    assert worker_canonical("numpy==1.0 ;python_version<'3.12'") == ["numpy==1.0; python_version<'3.12'"]
+
+
+def test_options_lines_stay_ahead_of_packages():
+    text = "numpy==1.0\n--extra-index-url  https://x\n"
+    assert worker_canonical(text) == ["--extra-index-url https://x", "numpy==1.0"]
+
+
+def test_hashes_are_not_glued_to_the_specifier():
+    lines = worker_canonical("numpy==1.0 --hash=sha256:abc\n")
+    assert lines == ["numpy==1.0 --hash=sha256:abc"]
+
+
+def test_hash_order_and_spelling_do_not_change_the_key():
+    a = "numpy==1.0 --hash=sha256:abc --hash=sha256:def\n"
+    b = "numpy==1.0 \\\n  --hash sha256:def \\\n  --hash=sha256:abc\n"
+    assert requirements_hash(a.encode()) == requirements_hash(b.encode())
@@ -1,40 +1,147 @@
 import asyncio
+import json
 import redis.asyncio as redis
 
 
-async def heartbeat_loop(worker_id: str, r: redis.Redis, interval: int = 5):
-    """Proves this worker is alive by refreshing a TTL key."""
+WORKER_HEARTBEATS = "workers:heartbeats"
+WORKER_SLOTS = "workers:slots"
+WORKER_IN_USE = "workers:in_use"
+WORKER_ENVS = "workers:envs"
+WORKER_USAGE = "workers:usage"
+WORKER_CAPACITY = "workers:capacity"
+HEARTBEAT_TTL = 15
+WORKER_GROUP = "worker"
+
+# Score the heartbeat with Redis server time so scheduler and workers never
+# compare clocks, and refresh liveness and capacity in one round trip.
+HEARTBEAT_LUA = """
+local t = redis.call('time')
+local now_ms = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+redis.call('zadd', KEYS[1], now_ms, ARGV[1])
+redis.call('hset', KEYS[2], ARGV[1], ARGV[2])
+redis.call('hset', KEYS[3], ARGV[1], ARGV[3])
+redis.call('hset', KEYS[5], ARGV[1], ARGV[5])
+redis.call('set', KEYS[4], 'alive', 'EX', ARGV[4])
+return now_ms
+"""
+
+
+async def send_heartbeat(worker_id: str, r: redis.Redis, slots: int, in_use: int, usage: dict = None):
+    await r.eval(
+        HEARTBEAT_LUA, 5,
+        WORKER_HEARTBEATS, WORKER_SLOTS, WORKER_IN_USE, f"worker:heartbeat:{worker_id}", WORKER_USAGE,
+        worker_id, slots, in_use, HEARTBEAT_TTL, json.dumps(usage or {}),
+    )
+
+
+async def report_capacity(worker_id: str, r: redis.Redis, in_use: int, freed: bool = False):
+    """Publish the current number of busy slots without waiting for a heartbeat.
+
+    When a slot was ``freed``, also wake schedulers waiting for capacity.
+    """
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.hset(WORKER_IN_USE, worker_id, in_use)
+        if freed:
+            pipe.publish(WORKER_CAPACITY, worker_id)
+        await pipe.execute()
+
+
+async def report_envs(worker_id: str, r: redis.Redis, envs: set[str]):
+    """Publish the environment cache keys this worker can run without a build."""
+    await r.hset(WORKER_ENVS, worker_id, json.dumps(sorted(envs)))
+
+
+async def heartbeat_loop(worker_id: str, r: redis.Redis, slots: int, in_use, interval: int = 5, usage=None):
+    """Proves this worker is alive by refreshing its registry entry.
+
+    ``in_use`` is a callable returning the number of busy slots right now;
+    ``usage``, if given, returns the slot pool's running / queued jobs and
+    CPU and memory use, published to ``workers:usage``.
+    """
     while True:
         try:
-            await r.set(f"worker:heartbeat:{worker_id}", "alive", ex=15)
+            await send_heartbeat(worker_id, r, slots, in_use(), usage() if usage else None)
             await asyncio.sleep(interval)
         except Exception as e:
             print(f"Heartbeat error: {e}")
             await asyncio.sleep(interval)
 
 
-async def register_worker(worker_id: str, r: redis.Redis, workers_set: str):
-    """Register this worker in the available workers set."""
-    await r.sadd(workers_set, worker_id)
-    print(f"Registered {worker_id} in {workers_set}")
-
+async def register_worker(worker_id: str, r: redis.Redis, slots: int):
+    """Register this worker in the fleet registry with all slots free."""
+    await send_heartbeat(worker_id, r, slots, 0)
+    await r.publish(WORKER_CAPACITY, worker_id)
+    print(f"Registered {worker_id} in {WORKER_HEARTBEATS} with {slots} slots")
 
-async def listen_for_jobs(worker_id: str, r: redis.Redis, callback):
-    """Listen for job assignments via Redis Pub/Sub."""
-    channel = f"worker:{worker_id}:jobs"
-    pubsub = r.pubsub()
-    await pubsub.subscribe(channel)
-    print(f"Subscribed to {channel} for job assignments...")
 
+async def _ensure_dispatch_group(r: redis.Redis, stream: str):
     try:
-        async for message in pubsub.listen():
-            if message["type"] == "message":
-                job_id = message["data"].decode("utf-8") if isinstance(message["data"], bytes) else message["data"]
+        await r.xgroup_create(stream, WORKER_GROUP, id="0", mkstream=True)
+    except redis.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def listen_for_jobs(worker_id: str, r: redis.Redis, callback, batch_size: int = 10, max_pending: int = 0):
+    """Consume job assignments from this worker's durable dispatch stream.
+
+    Entries are acknowledged only once ``callback`` returns, so assignments
+    delivered before a crash or disconnect are redelivered on restart. With
+    ``max_pending`` set, no more than that many callbacks are outstanding;
+    further entries wait in the stream until one finishes.
+    """
+    stream = f"worker:{worker_id}:dispatch"
+    await _ensure_dispatch_group(r, stream)
+    print(f"Consuming {stream} for job assignments...")
+
+    async def handle(message_id, job_id: str):
+        try:
+            await callback(job_id)
+        finally:
+            await r.xack(stream, WORKER_GROUP, message_id)
+
+    pending = set()
+
+    # Replay our own unacknowledged entries first, then follow new ones.
+    last_id = "0"
+    while True:
+        try:
+            if max_pending and len(pending) >= max_pending:
+                await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            streams = await r.xreadgroup(
+                WORKER_GROUP,
+                worker_id,
+                {stream: last_id},
+                count=min(batch_size, max_pending - len(pending)) if max_pending else batch_size,
+                block=None if last_id != ">" else 5000,
+            )
+            messages = streams[0][1] if streams else []
+
+            if last_id != ">":
+                if not messages:
+                    last_id = ">"
+                    continue
+                last_id = messages[-1][0]
+
+            for message_id, data in messages:
+                if not data:
+                    # Entries trimmed from the stream replay without fields.
+                    await r.xack(stream, WORKER_GROUP, message_id)
+                    continue
+                job_id = data.get(b"job_id", b"").decode("utf-8")
                 print(f"Received job {job_id}")
-                asyncio.create_task(callback(job_id))
-    except asyncio.CancelledError:
-        await pubsub.unsubscribe(channel)
-        raise
-    except Exception as e:
-        print(f"Error in job listener: {e}")
-        await asyncio.sleep(5)
+                task = asyncio.create_task(handle(message_id, job_id))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, redis.ResponseError) and "NOGROUP" in str(e):
+                # Recovery dropped our stream while we were presumed dead.
+                print(f"Dispatch stream {stream} was reset, re-creating it")
+                await _ensure_dispatch_group(r, stream)
+                last_id = ">"
+                continue
+            print(f"Error in job listener: {e}")
+            await asyncio.sleep(5)
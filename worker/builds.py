@@ -0,0 +1,133 @@
+import asyncio
+import contextlib
+import json
+import os
+import redis.asyncio as redis
+from .env_resolver import env_cache_key, has_image, resolve_image, export_image, import_image
+from .reporter import ENV_BUILD_WAITS, ENV_IMAGE_LOADS, ENV_IMAGE_EXPORTS
+
+BUILD_LEASE_PREFIX = "envs:build:"
+# Cache key -> {"object", "digest", "size"} of images exported to MinIO.
+ENV_IMAGES = "envs:images"
+
+BUILD_LEASE_TTL_MS = int(os.getenv("BUILD_LEASE_TTL_MS", "30000"))
+# How often a worker waiting on another's build checks the lease.
+BUILD_WAIT_POLL_SECS = float(os.getenv("BUILD_WAIT_POLL_SECS", "1"))
+
+RENEW_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class BuildCoordinator:
+    """Single-flight environment builds.
+
+    Jobs on this worker that need the same environment share one future,
+    so only the first starts a build. Across the fleet, a build runs under
+    a Redis lease on its cache key (renewed while the build lasts, so a
+    crashed builder's lease simply expires); other workers wait for the
+    lease instead of hitting the package index at the same time.
+
+    Built images are exported to MinIO once, so a worker that lacks an
+    environment loads it from there rather than building it again.
+    """
+
+    def __init__(self, r: redis.Redis, worker_id: str, minio_client):
+        self._r = r
+        self._worker_id = worker_id
+        self._minio = minio_client
+        self._builds: dict[str, asyncio.Future] = {}
+
+    async def resolve(self, base_image: str, req_path: str) -> tuple[str, bool]:
+        """``resolve_image`` with builds deduplicated; returns (image_tag, cache_hit)."""
+        key = await asyncio.to_thread(env_cache_key, base_image, req_path)
+        if key is None:
+            return base_image, True
+
+        if key in self._builds:
+            ENV_BUILD_WAITS.labels(scope="worker").inc()
+            image, _ = await asyncio.shield(self._builds[key])
+            return image, True
+
+        build = asyncio.get_running_loop().create_future()
+        self._builds[key] = build
+        try:
+            result = await self._resolve(key, base_image, req_path)
+            build.set_result(result)
+            return result
+        except BaseException as e:
+            build.set_exception(e)
+            # Mark it retrieved: nobody may be waiting on it.
+            build.exception()
+            raise
+        finally:
+            del self._builds[key]
+
+    async def _resolve(self, key: str, base_image: str, req_path: str) -> tuple[str, bool]:
+        if await asyncio.to_thread(has_image, key) or await self._load(key):
+            return key, True
+        async with self._lease(key):
+            # Whoever held the lease before us may have just exported it.
+            if await self._load(key):
+                return key, True
+            image, cache_hit = await asyncio.to_thread(resolve_image, base_image, req_path)
+            if not cache_hit:
+                await self._export(key)
+            return image, cache_hit
+
+    async def _load(self, key: str) -> bool:
+        entry = await self._r.hget(ENV_IMAGES, key)
+        if entry is None:
+            return False
+        loaded = await asyncio.to_thread(import_image, self._minio, key, json.loads(entry))
+        if loaded:
+            ENV_IMAGE_LOADS.inc()
+            print(f"Loaded environment {key} from shared storage")
+        return loaded
+
+    async def _export(self, key: str):
+        try:
+            entry = await asyncio.to_thread(export_image, self._minio, key)
+            await self._r.hset(ENV_IMAGES, key, json.dumps(entry))
+            ENV_IMAGE_EXPORTS.inc()
+        except Exception as e:
+            print(f"Failed to export environment {key}: {e}")
+
+    @contextlib.asynccontextmanager
+    async def _lease(self, key: str):
+        name = f"{BUILD_LEASE_PREFIX}{key}"
+        waited = False
+        while not await self._r.set(name, self._worker_id, nx=True, px=BUILD_LEASE_TTL_MS):
+            if not waited:
+                ENV_BUILD_WAITS.labels(scope="fleet").inc()
+                print(f"Waiting for another worker to build {key}")
+                waited = True
+            await asyncio.sleep(BUILD_WAIT_POLL_SECS)
+
+        renewal = asyncio.create_task(self._renew(name))
+        try:
+            yield
+        finally:
+            renewal.cancel()
+            try:
+                await self._r.eval(RELEASE_LUA, 1, name, self._worker_id)
+            except Exception as e:
+                print(f"Failed to release build lease {name}: {e}")
+
+    async def _renew(self, name: str):
+        while True:
+            await asyncio.sleep(BUILD_LEASE_TTL_MS / 3000)
+            try:
+                await self._r.eval(RENEW_LUA, 1, name, self._worker_id, BUILD_LEASE_TTL_MS)
+            except Exception as e:
+                print(f"Failed to renew build lease {name}: {e}")
@@ -1,58 +1,332 @@
 import hashlib
-import io
+import json
 import os
+import re
+import shutil
+import tarfile
+import uuid
+from typing import Optional
 import docker
 
 docker_client = docker.from_env()
 
+ENV_LABEL = "scheduler.env_key"
+BASE_LABEL = "scheduler.env_base"
+PACKAGES_LABEL = "scheduler.env_packages"
+PACK_DIR = os.path.join(os.getenv("TMP_JOBS_DIR", "/tmp/jobs"), "packs")
+BUILD_DIR = os.path.join(os.getenv("TMP_JOBS_DIR", "/tmp/jobs"), "builds")
+# Shared by every build on the host; it lives under TMP_JOBS_DIR so the
+# path is the same for the worker and the Docker daemon.
+PIP_CACHE_DIR = os.getenv("PIP_CACHE_DIR", os.path.join(os.getenv("TMP_JOBS_DIR", "/tmp/jobs"), "pip-cache"))
+IMAGE_PREFIX = "images"
+# MinIO needs at least 5 MiB per part.
+IMAGE_PART_SIZE = int(os.getenv("MINIO_PART_SIZE", str(16 * 1024 * 1024)))
+PACK_MEMBERS = ("manifest.json", "script.py", "requirements.txt")
 
-def pull_bundle(minio_client, job_id: str, tmp_dir: str):
-    """Download script + requirements from MinIO to local /tmp."""
+
+def fetch_pack(minio_client, digest: str) -> tuple[str, str]:
+    """Unpack a packed bundle into the local cache with one streaming GET.
+
+    The tar is read as it arrives, so nothing but the extracted files
+    touches disk. Returns (script_path, requirements_path).
+    """
+    path = os.path.join(PACK_DIR, digest)
+    if not os.path.isdir(path):
+        part = f"{path}.{uuid.uuid4().hex}.part"
+        os.makedirs(part)
+        response = minio_client.get_object("jobs", f"packs/sha256/{digest}.tar.gz")
+        try:
+            with tarfile.open(fileobj=response, mode="r|gz") as tar:
+                for member in tar:
+                    # Only the known members, so a crafted archive cannot
+                    # write outside the bundle directory.
+                    if member.isfile() and member.name in PACK_MEMBERS:
+                        with open(os.path.join(part, member.name), "wb") as f:
+                            shutil.copyfileobj(tar.extractfile(member), f)
+        except Exception:
+            shutil.rmtree(part, ignore_errors=True)
+            raise
+        finally:
+            response.close()
+            response.release_conn()
+        try:
+            os.rename(part, path)
+        except OSError:
+            # A concurrent fetch got there first.
+            shutil.rmtree(part, ignore_errors=True)
+    return os.path.join(path, "script.py"), os.path.join(path, "requirements.txt")
+
+
+def pull_bundle(minio_client, prefix: str, tmp_dir: str, manifest: dict) -> tuple[str, str]:
+    """Download a bundle stored under ``prefix`` (the job id) into ``tmp_dir``,
+    as jobs submitted before packed bundles have it.
+    Returns (script_path, requirements_path).
+    """
     os.makedirs(tmp_dir, exist_ok=True)
-    minio_client.fget_object("jobs", f"{job_id}/script.py", f"{tmp_dir}/script.py")
+    minio_client.fget_object("jobs", f"{prefix}/script.py", f"{tmp_dir}/script.py")
     try:
         minio_client.fget_object(
-            "jobs", f"{job_id}/requirements.txt", f"{tmp_dir}/requirements.txt"
+            "jobs", f"{prefix}/requirements.txt", f"{tmp_dir}/requirements.txt"
         )
     except Exception:
         with open(f"{tmp_dir}/requirements.txt", "w") as f:
             f.write("")
+    return f"{tmp_dir}/script.py", f"{tmp_dir}/requirements.txt"
+
+
+_REQUIREMENT = re.compile(r"([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*(.*)")
+
+
+def _canonical_requirement(line: str) -> str:
+    # Per-requirement options (``--hash=...``) follow the specifier; they are
+    # kept, as ``--name=value`` and sorted, but must not be read as part of it.
+    line, *options = re.split(r"\s+(?=--)", line)
+    options = sorted(re.sub(r"^(--[\w-]+)\s+", r"\1=", " ".join(o.split())) for o in options)
+    match = _REQUIREMENT.fullmatch(line)
+    if not match:
+        return " ".join([line, *options])
+    name, extras, rest = match.groups()
+    name = re.sub(r"[-_.]+", "-", name).lower()
+    if extras:
+        extras = "[" + ",".join(sorted(e.strip().lower() for e in extras[1:-1].split(",") if e.strip())) + "]"
+    spec, _, marker = rest.partition(";")
+    if spec.startswith("@"):
+        spec = " @ " + spec[1:].strip()
+    else:
+        spec = ",".join(sorted(s for s in "".join(spec.split()).split(",") if s))
+    marker = " ".join(marker.split())
+    return " ".join([f"{name}{extras or ''}{spec}" + (f"; {marker}" if marker else ""), *options])
+
+
+def canonical_requirements(text: str) -> list[str]:
+    """requirements.txt reduced to what pip acts on.
+
+    Comments, blank lines, line continuations and spacing are dropped,
+    package names and extras are normalised, and packages are deduplicated
+    and sorted; option lines (``--index-url`` etc.) keep their order ahead
+    of them. Mirrors ``api.services.environments.canonical_requirements``.
+    """
+    options, packages = [], set()
+    for line in text.replace("\\\n", " ").splitlines():
+        line = re.sub(r"(^|\s)#.*$", "", line).strip()
+        if not line:
+            continue
+        if line.startswith("-"):
+            options.append(" ".join(line.split()))
+        else:
+            packages.add(_canonical_requirement(line))
+    return options + sorted(packages)
+
+
+def read_requirements(req_path: str) -> list[str]:
+    with open(req_path, encoding="utf-8", errors="replace") as f:
+        return canonical_requirements(f.read())
 
 
-def compute_cache_key(base_image: str, req_path: str) -> str:
-    """Hash requirements.txt to produce a stable, unique image tag."""
-    content = open(req_path, "rb").read()
-    req_hash = hashlib.sha256(content).hexdigest()[:12]
+def compute_cache_key(base_image: str, requirements: list[str]) -> str:
+    """Hash the canonical requirements to produce a stable, unique image tag."""
+    req_hash = hashlib.sha256("\n".join(requirements).encode()).hexdigest()[:12]
     safe_base = base_image.replace(":", "-").replace("/", "-")
     return f"{safe_base}-{req_hash}"
 
 
+def env_cache_key(base_image: str, req_path: str) -> Optional[str]:
+    """Tag ``resolve_image`` would use, or None when the bundle runs on the base image."""
+    requirements = read_requirements(req_path)
+    return compute_cache_key(base_image, requirements) if requirements else None
+
+
+def has_image(tag: str) -> bool:
+    try:
+        docker_client.images.get(tag)
+        return True
+    except docker.errors.ImageNotFound:
+        return False
+
+
+def _closest_env(base_image: str, requirements: list[str]) -> str:
+    """The cached environment on ``base_image`` that has the most of
+    ``requirements`` and nothing else, or the base image itself."""
+    wanted = set(requirements)
+    best, best_count = base_image, 0
+    for img in docker_client.images.list(filters={"label": ENV_LABEL}):
+        if img.labels.get(BASE_LABEL) != base_image:
+            continue
+        try:
+            have = set(json.loads(img.labels.get(PACKAGES_LABEL, "[]")))
+        except ValueError:
+            continue
+        if have and have <= wanted and len(have) > best_count:
+            best, best_count = img.labels[ENV_LABEL], len(have)
+    return best
+
+
+def _build_env(base_image: str, requirements: list[str], cache_key: str) -> str:
+    """Install ``requirements`` on top of the closest cached environment and
+    commit the result as ``cache_key``; returns the image built on.
+
+    pip gets the full list, so packages the parent already has are kept as
+    they are and only the rest are installed. Downloads and wheels go to
+    PIP_CACHE_DIR, which is mounted rather than baked into the image.
+    """
+    parent = _closest_env(base_image, requirements)
+    build_dir = os.path.join(BUILD_DIR, f"{cache_key}.{uuid.uuid4().hex}")
+    os.makedirs(build_dir)
+    os.makedirs(PIP_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(build_dir, "requirements.txt"), "w") as f:
+        f.write("\n".join(requirements) + "\n")
+
+    container = None
+    try:
+        container = docker_client.containers.run(
+            image=parent,
+            command=[
+                "python3", "-m", "pip", "install",
+                "--cache-dir", "/pip-cache", "-r", "/build/requirements.txt",
+            ],
+            volumes={
+                build_dir: {"bind": "/build", "mode": "ro"},
+                PIP_CACHE_DIR: {"bind": "/pip-cache", "mode": "rw"},
+            },
+            detach=True,
+        )
+        if container.wait()["StatusCode"] != 0:
+            logs = container.logs(tail=50).decode("utf-8", errors="replace")
+            raise RuntimeError(f"pip install failed for {cache_key}:\n{logs}")
+        # Keep the parent's command, not the pip invocation.
+        config = docker_client.images.get(parent).attrs["Config"]
+        container.commit(
+            repository=cache_key,
+            conf={
+                "Cmd": config.get("Cmd"),
+                "Labels": {
+                    ENV_LABEL: cache_key,
+                    BASE_LABEL: base_image,
+                    PACKAGES_LABEL: json.dumps(requirements),
+                },
+            },
+        )
+    finally:
+        if container is not None:
+            container.remove(force=True)
+        shutil.rmtree(build_dir, ignore_errors=True)
+    return parent
+
+
 def resolve_image(base_image: str, req_path: str) -> tuple[str, bool]:
     """Return a Docker image tag with all dependencies installed.
 
     Returns (image_tag, cache_hit).
     """
-    reqs = open(req_path).read().strip()
-    if not reqs:
+    requirements = read_requirements(req_path)
+    if not requirements:
         return base_image, True
 
-    cache_key = compute_cache_key(base_image, req_path)
-
-    try:
-        docker_client.images.get(cache_key)
+    cache_key = compute_cache_key(base_image, requirements)
+    if has_image(cache_key):
         return cache_key, True
-    except docker.errors.ImageNotFound:
-        pass
-
-    packages = " ".join(reqs.splitlines())
-    dockerfile = f"""\
-FROM {base_image}
-RUN pip install --no-cache-dir {packages}
-""".encode()
-
-    docker_client.images.build(
-        fileobj=io.BytesIO(dockerfile),
-        tag=cache_key,
-        rm=True,
-    )
+
+    parent = _build_env(base_image, requirements, cache_key)
+    print(f"Built environment {cache_key} on {parent}")
     return cache_key, False
+
+
+class _ChunkReader:
+    """File-like view of a chunk generator, counting the bytes read."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data = self._buffer if size < 0 else self._buffer[:size]
+        self._buffer = self._buffer[len(data):]
+        self.size += len(data)
+        return data
+
+
+def export_image(minio_client, tag: str) -> dict:
+    """Stream ``docker save`` of an environment image to MinIO.
+
+    Returns what other workers need to load it: the object name, the
+    image's content digest and the archive size.
+    """
+    image = docker_client.images.get(tag)
+    reader = _ChunkReader(image.save(named=True))
+    name = f"{IMAGE_PREFIX}/{tag}.tar"
+    minio_client.put_object(
+        "jobs", name, reader, length=-1, part_size=IMAGE_PART_SIZE,
+        content_type="application/x-tar",
+    )
+    return {"object": name, "digest": image.id, "size": reader.size}
+
+
+def import_image(minio_client, tag: str, entry: dict) -> bool:
+    """Load an exported environment image; False if it is missing or its
+    digest does not match what the exporter recorded."""
+    try:
+        response = minio_client.get_object("jobs", entry["object"])
+    except Exception as e:
+        print(f"Image archive for {tag} unavailable: {e}")
+        return False
+    try:
+        loaded = docker_client.images.load(response)
+    except Exception as e:
+        print(f"Failed to load image {tag}: {e}")
+        return False
+    finally:
+        response.close()
+        response.release_conn()
+
+    for image in loaded:
+        if image.id == entry["digest"]:
+            image.tag(tag)
+            return True
+    print(f"Loaded image for {tag} does not match digest {entry['digest']}")
+    return False
+
+
+def list_env_images() -> tuple[int, list[tuple[str, int, float]]]:
+    """Disk used by the daemon's image layers, each shared layer counted
+    once, and (cache key, bytes freed by removing it, created timestamp) for
+    every environment image.
+
+    An environment that a newer one was built on shares all of its layers
+    with it, so removing it frees nothing until the newer one is gone.
+    """
+    df = docker_client.df()
+    images = []
+    for img in df.get("Images") or []:
+        tag = (img.get("Labels") or {}).get(ENV_LABEL)
+        if tag:
+            unique = img.get("Size", 0) - max(img.get("SharedSize", 0), 0)
+            images.append((tag, unique, float(img.get("Created", 0))))
+    return df.get("LayersSize", 0), images
+
+
+def daemon_id() -> str:
+    """Identifies the Docker daemon, which several workers may share."""
+    return docker_client.info().get("ID", "")
+
+
+def remove_image(tag: str) -> bool:
+    """Remove an environment image; False if Docker refuses, e.g. because a
+    container still uses it."""
+    try:
+        docker_client.images.remove(tag)
+        return True
+    except docker.errors.APIError as e:
+        print(f"Could not evict {tag}: {e}")
+        return False
+
+
+def list_cached_envs() -> set[str]:
+    """Cache keys of every environment image built on this Docker daemon."""
+    images = docker_client.images.list(filters={"label": ENV_LABEL})
+    return {img.labels[ENV_LABEL] for img in images if img.labels.get(ENV_LABEL)}
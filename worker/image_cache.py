@@ -0,0 +1,110 @@
+import asyncio
+import collections
+import contextlib
+import os
+import time
+import redis.asyncio as redis
+from .env_resolver import list_env_images, remove_image
+from .reporter import CACHE_BYTES, CACHE_EVICTIONS
+
+# Disk the daemon's images may use; 0 disables eviction.
+IMAGE_CACHE_BUDGET_MB = int(os.getenv("IMAGE_CACHE_BUDGET_MB", "20480"))
+IMAGE_CACHE_SWEEP_SECS = float(os.getenv("IMAGE_CACHE_SWEEP_SECS", "60"))
+# Pins of every worker on a Docker daemon, "{worker_id}|{tag}" scored by
+# expiry; each worker renews its own on every sweep.
+IMAGE_PINS_PREFIX = "envs:pins:"
+IMAGE_PIN_TTL_SECS = 3 * IMAGE_CACHE_SWEEP_SECS
+
+
+class ImageCache:
+    """Least-recently-used eviction of environment images under a disk budget.
+
+    Jobs pin the images they will run on from the moment they are accepted
+    until they finish, so an image needed by a running or queued job is
+    never evicted. Pins are shared through Redis with the other workers on
+    the same Docker daemon, which sweep the same images. Images not used
+    since the worker started count as last used when they were created.
+    """
+
+    def __init__(self, r: redis.Redis, worker_id: str, daemon: str, budget_mb: int = IMAGE_CACHE_BUDGET_MB):
+        self.budget = budget_mb * 2**20
+        self._r = r
+        self._worker_id = worker_id
+        self._pins_key = f"{IMAGE_PINS_PREFIX}{daemon}"
+        self._last_used: dict[str, float] = {}
+        self._pins = collections.Counter()
+
+    def touch(self, tag: str):
+        self._last_used[tag] = time.time()
+
+    @contextlib.asynccontextmanager
+    async def pinned(self, tag: str):
+        if not tag:
+            yield
+            return
+        self._pins[tag] += 1
+        self.touch(tag)
+        if self._pins[tag] == 1:
+            await self._publish([tag])
+        try:
+            yield
+        finally:
+            self._pins[tag] -= 1
+            if not self._pins[tag]:
+                del self._pins[tag]
+                await self._unpublish(tag)
+            self.touch(tag)
+
+    async def _publish(self, tags):
+        if not tags:
+            return
+        expires = time.time() + IMAGE_PIN_TTL_SECS
+        try:
+            await self._r.zadd(self._pins_key, {f"{self._worker_id}|{t}": expires for t in tags})
+        except Exception as e:
+            print(f"Failed to publish image pins: {e}")
+
+    async def _unpublish(self, tag: str):
+        try:
+            await self._r.zrem(self._pins_key, f"{self._worker_id}|{tag}")
+        except Exception as e:
+            print(f"Failed to release image pin {tag}: {e}")
+
+    async def _shared_pins(self) -> set[str]:
+        async with self._r.pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(self._pins_key, "-inf", time.time())
+            pipe.zrange(self._pins_key, 0, -1)
+            _, members = await pipe.execute()
+        return {m.decode("utf-8").partition("|")[2] for m in members}
+
+    async def sweep(self) -> list[str]:
+        """Evict unpinned images, oldest use first, until under budget.
+
+        Returns the evicted cache keys.
+        """
+        await self._publish(list(self._pins))
+        total, images = await asyncio.to_thread(list_env_images)
+        evicted = []
+        while self.budget and total > self.budget:
+            removed = False
+            # Images that free nothing are skipped; once the environments
+            # built on them are gone they are sized again below.
+            candidates = [i for i in images if i[1] > 0]
+            for tag, size, created in sorted(candidates, key=lambda i: self._last_used.get(i[0], i[2])):
+                if total <= self.budget:
+                    break
+                # Checked right before each removal: jobs pin while we await.
+                if tag in self._pins or tag in await self._shared_pins():
+                    continue
+                if await asyncio.to_thread(remove_image, tag):
+                    total -= size
+                    removed = True
+                    evicted.append(tag)
+                    self._last_used.pop(tag, None)
+                    CACHE_EVICTIONS.inc()
+                    print(f"Evicted environment {tag} ({size // 2**20} MiB)")
+            if not removed:
+                break
+            total, images = await asyncio.to_thread(list_env_images)
+        CACHE_BYTES.set(total)
+        return evicted
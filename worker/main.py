@@ -1,4 +1,6 @@
 import asyncio
+import collections
+import contextlib
 import os
 import json
 from datetime import datetime, timezone
@@ -9,22 +11,38 @@ from prometheus_client import start_http_server
 
 from .database import get_db_session
 from .models import Job, JobStatus
-from .agent import heartbeat_loop, register_worker, listen_for_jobs
+from .agent import (
+    heartbeat_loop, register_worker, listen_for_jobs, report_capacity, report_envs,
+)
 from .reporter import (
-    update_state, report_success, report_failure, report_cache,
+    update_state, report_success, report_failure, report_cache, emit_event,
     JOB_DURATION,
 )
-from .env_resolver import pull_bundle, resolve_image
+from .env_resolver import fetch_pack, pull_bundle, list_cached_envs, daemon_id
+from .builds import BuildCoordinator
+from .image_cache import ImageCache, IMAGE_CACHE_SWEEP_SECS
 from .runner import run_job
 from .executor import DockerExecutor
+from .slots import SlotPool, host_mem_mb, job_demand
+from .warm_pool import warm_pool, remove_stale_containers
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 MINIO_ENDPOINT = os.getenv("MINIO_ENDPOINT", "minio:9000")
 MINIO_ACCESS_KEY = os.getenv("MINIO_ROOT_USER", "minio")
 MINIO_SECRET_KEY = os.getenv("MINIO_ROOT_PASSWORD", "minio123")
-WORKERS_SET = "available_workers"
 CONSUMER_NAME = os.getenv("HOSTNAME", "worker-1")
 TMP_JOBS_DIR = os.getenv("TMP_JOBS_DIR", "/tmp/jobs")
+WORKER_SLOTS = int(os.getenv("WORKER_SLOTS", "4"))
+# Budgets the running jobs' cpu_limit / mem_limit must fit in.
+WORKER_CPUS = float(os.getenv("WORKER_CPUS", str(os.cpu_count() or 1)))
+WORKER_MEM_MB = int(os.getenv("WORKER_MEM_MB", "0")) or host_mem_mb()
+# Jobs accepted beyond those running wait locally; the rest stay in the
+# dispatch stream.
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", str(WORKER_SLOTS)))
+DISPATCH_BATCH_SIZE = int(os.getenv("DISPATCH_BATCH_SIZE", "10"))
+# Job arrays remembered for reuse; the least recently used is forgotten.
+BUNDLE_CACHE_SIZE = int(os.getenv("BUNDLE_CACHE_SIZE", "256"))
+ACTIVE_STATES = (JobStatus.ASSIGNED, JobStatus.PULLING, JobStatus.INSTALLING, JobStatus.RUNNING)
 
 
 def get_minio_client() -> Minio:
@@ -38,10 +56,26 @@ def get_minio_client() -> Minio:
 
 _legacy_executor = DockerExecutor()
 _minio_client = None
+_redis = None
+_builds: BuildCoordinator = None
+_slots_in_use = 0
+_slot_pool = SlotPool(WORKER_SLOTS, WORKER_CPUS, WORKER_MEM_MB)
+_image_cache: ImageCache = None
+_cached_envs: set[str] = set()
+# Jobs being handled here; a job dispatched twice (the scheduler re-sends
+# assignments whose dispatch may have failed) runs once.
+_active_jobs: set[str] = set()
+# Packed bundle digest -> resolved image, so every task of a job array after
+# the first on this worker skips the build. An LRU cache of BUNDLE_CACHE_SIZE
+# entries.
+_bundle_images: "collections.OrderedDict[str, tuple[str, bool]]" = collections.OrderedDict()
+# Bundle digest, or "image:" + digest for its image -> (lock, tasks holding
+# or waiting on it); dropped when the last one is done.
+_bundle_locks: dict[str, tuple[asyncio.Lock, int]] = {}
 
 
 async def main():
-    global _minio_client
+    global _minio_client, _redis, _builds, _image_cache
     print(f"Worker {CONSUMER_NAME} starting...")
 
     try:
@@ -51,16 +85,68 @@ async def main():
         print(f"Failed to start metrics: {e}")
 
     r = redis.from_url(REDIS_URL)
+    _redis = r
     _minio_client = get_minio_client()
+    _builds = BuildCoordinator(r, CONSUMER_NAME, _minio_client)
+    _image_cache = ImageCache(r, CONSUMER_NAME, await asyncio.to_thread(daemon_id))
+
+    await register_worker(CONSUMER_NAME, r, WORKER_SLOTS)
+
+    if warm_pool.enabled:
+        await asyncio.to_thread(remove_stale_containers)
 
-    await register_worker(CONSUMER_NAME, r, WORKERS_SET)
+    _cached_envs.update(await asyncio.to_thread(list_cached_envs))
+    await report_envs(CONSUMER_NAME, r, _cached_envs)
+
+    asyncio.create_task(heartbeat_loop(
+        CONSUMER_NAME, r, WORKER_SLOTS, lambda: _slots_in_use, usage=_slot_pool.usage
+    ))
+    asyncio.create_task(_image_cache_loop())
+
+    await listen_for_jobs(
+        CONSUMER_NAME, r, process_job,
+        batch_size=DISPATCH_BATCH_SIZE, max_pending=WORKER_SLOTS + WORKER_QUEUE_SIZE,
+    )
 
-    asyncio.create_task(heartbeat_loop(CONSUMER_NAME, r))
 
-    await listen_for_jobs(CONSUMER_NAME, r, process_job)
+async def _image_cache_loop():
+    while True:
+        await asyncio.sleep(IMAGE_CACHE_SWEEP_SECS)
+        try:
+            evicted = await _image_cache.sweep()
+            if evicted:
+                _cached_envs.difference_update(evicted)
+                for key, (image, _) in list(_bundle_images.items()):
+                    if image in evicted:
+                        del _bundle_images[key]
+                await report_envs(CONSUMER_NAME, _redis, _cached_envs)
+        except Exception as e:
+            print(f"Image cache sweep error: {e}")
+
+
+async def _set_slots_in_use(delta: int):
+    global _slots_in_use
+    _slots_in_use += delta
+    try:
+        await report_capacity(CONSUMER_NAME, _redis, _slots_in_use, freed=delta < 0)
+    except Exception as e:
+        print(f"Capacity report error: {e}")
 
 
 async def process_job(job_id: str):
+    if job_id in _active_jobs:
+        print(f"Job {job_id} is already being handled here, dropping duplicate dispatch")
+        return
+    _active_jobs.add(job_id)
+    await _set_slots_in_use(1)
+    try:
+        await _run_job(job_id)
+    finally:
+        _active_jobs.discard(job_id)
+        await _set_slots_in_use(-1)
+
+
+async def _run_job(job_id: str):
     async_session = get_db_session()
     async for session in async_session:
         try:
@@ -71,10 +157,21 @@ async def process_job(job_id: str):
                 print(f"Job {job_id} not found in DB")
                 return
 
-            if _check_minio_bundle(_minio_client, job_id):
-                await _process_bundle_job(session, job, _minio_client)
-            else:
-                await _process_legacy_job(session, job, _legacy_executor)
+            if not _still_ours(job):
+                return
+
+            # End the read transaction so a queued job holds no connection.
+            await session.commit()
+            # Keep the job's environment from eviction while it waits and runs.
+            async with _image_cache.pinned(job.env_key):
+                async with _slot_pool.reserve(*job_demand(job.manifest)):
+                    await session.refresh(job)
+                    if not _still_ours(job):
+                        return
+                    if job.manifest or _check_minio_bundle(_minio_client, job_id):
+                        await _process_bundle_job(session, job, _minio_client)
+                    else:
+                        await _process_legacy_job(session, job, _legacy_executor)
 
         except Exception as e:
             print(f"Failed processing job {job_id}: {e}")
@@ -84,52 +181,140 @@ async def process_job(job_id: str):
         break
 
 
+def _still_ours(job) -> bool:
+    # Redelivered dispatches may refer to jobs recovery has moved on.
+    if job.assigned_worker != CONSUMER_NAME or job.status not in ACTIVE_STATES:
+        print(f"Skipping job {job.id}: {job.status} on {job.assigned_worker}")
+        return False
+    return True
+
+
 def _check_minio_bundle(minio_client: Minio, job_id: str) -> bool:
     try:
-        minio_client.stat_object("jobs", f"{job_id}/script.py")
+        # Jobs from before packed bundles keep their manifest in MinIO;
+        # content-addressed ones have no script.py here.
+        minio_client.stat_object("jobs", f"{job_id}/manifest.json")
         return True
     except Exception:
         return False
 
 
+def _read_manifest(minio_client: Minio, prefix: str) -> dict:
+    try:
+        resp = minio_client.get_object("jobs", f"{prefix}/manifest.json")
+        manifest = json.loads(resp.read())
+        resp.close()
+        resp.release_conn()
+        return manifest
+    except Exception:
+        return {}
+
+
+async def _pull(minio_client: Minio, prefix: str, tmp_dir: str) -> tuple[str, str, dict]:
+    manifest = await asyncio.to_thread(_read_manifest, minio_client, prefix)
+    script_path, req_path = await asyncio.to_thread(pull_bundle, minio_client, prefix, tmp_dir, manifest)
+    return script_path, req_path, manifest
+
+
+def _remember(cache: collections.OrderedDict, key: str, value):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > BUNDLE_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def _recall(cache: collections.OrderedDict, key: str):
+    if key not in cache:
+        return None
+    cache.move_to_end(key)
+    return cache[key]
+
+
+@contextlib.asynccontextmanager
+async def _bundle_lock(key: str):
+    lock, users = _bundle_locks.get(key, (None, 0))
+    lock = lock or asyncio.Lock()
+    _bundle_locks[key] = (lock, users + 1)
+    try:
+        async with lock:
+            yield
+    finally:
+        lock, users = _bundle_locks[key]
+        if users > 1:
+            _bundle_locks[key] = (lock, users - 1)
+        else:
+            del _bundle_locks[key]
+
+
+async def _fetch_bundle(minio_client: Minio, job) -> tuple[str, str, dict]:
+    """Download a job's bundle.
+
+    Packed bundles are named by the manifest on the job row and cached by
+    digest, so the only round trip is the GET of a bundle this worker has
+    not unpacked before; tasks of a job array share one local copy. Older
+    jobs read their manifest from MinIO.
+    """
+    if job.manifest:
+        digest = job.manifest["bundle"].split(":", 1)[-1]
+        async with _bundle_lock(digest):
+            script_path, req_path = await asyncio.to_thread(fetch_pack, minio_client, digest)
+        return script_path, req_path, job.manifest
+
+    return await _pull(minio_client, str(job.id), os.path.join(TMP_JOBS_DIR, str(job.id)))
+
+
+async def _resolve_env(job, base_image: str, req_path: str) -> tuple[str, bool]:
+    """Resolve a bundle's image; packed bundles are cached by digest, which
+    covers the base image and requirements in their manifest."""
+    if not job.manifest:
+        return await _builds.resolve(base_image, req_path)
+
+    digest = job.manifest["bundle"].split(":", 1)[-1]
+    async with _bundle_lock(f"image:{digest}"):
+        cached = _recall(_bundle_images, digest)
+        if cached is not None:
+            return cached[0], True
+        resolved = await _builds.resolve(base_image, req_path)
+        _remember(_bundle_images, digest, resolved)
+        return resolved
+
+
 async def _process_bundle_job(session, job, minio_client: Minio):
     """New pipeline: pull from MinIO, resolve env, run with bind-mount."""
     job_id = str(job.id)
-    tmp_dir = os.path.join(TMP_JOBS_DIR, job_id)
 
     await update_state(session, job, JobStatus.PULLING, expected_status=JobStatus.ASSIGNED)
 
     print(f"Pulling bundle for job {job_id}...")
-    await asyncio.to_thread(pull_bundle, minio_client, job_id, tmp_dir)
-
-    manifest = {}
-    try:
-        resp = minio_client.get_object("jobs", f"{job_id}/manifest.json")
-        manifest = json.loads(resp.read())
-        resp.close()
-        resp.release_conn()
-    except Exception:
-        pass
+    script_path, req_path, manifest = await _fetch_bundle(minio_client, job)
 
     base_image = manifest.get("image_base", job.image_base or "python:3.11-slim")
-    req_path = os.path.join(tmp_dir, "requirements.txt")
-    script_path = os.path.join(tmp_dir, "script.py")
 
     await update_state(session, job, JobStatus.INSTALLING)
 
     print(f"Resolving environment for job {job_id}...")
-    image, cache_hit = await asyncio.to_thread(resolve_image, base_image, req_path)
+    image, cache_hit = await _resolve_env(job, base_image, req_path)
     report_cache(cache_hit)
     print(f"Image resolved: {image} (cache_hit={cache_hit})")
+    if image != base_image and image not in _cached_envs:
+        _cached_envs.add(image)
+        await report_envs(CONSUMER_NAME, _redis, _cached_envs)
 
     await update_state(
         session, job, JobStatus.RUNNING,
         started_at=datetime.now(timezone.utc),
     )
 
+    if job.array_id is not None:
+        env = {**manifest.get("env", {}), "ARRAY_ID": str(job.array_id), "ARRAY_INDEX": str(job.array_index)}
+        manifest = {**manifest, "env": env}
+
     print(f"Running job {job_id}...")
-    with JOB_DURATION.time():
-        exit_code, logs = await asyncio.to_thread(run_job, job_id, image, script_path, manifest)
+    async with _image_cache.pinned(image):
+        with JOB_DURATION.time():
+            exit_code, logs = await asyncio.to_thread(
+                run_job, job_id, image, script_path, manifest, job.command or []
+            )
 
     if exit_code == 0:
         report_success(job, exit_code, logs)
@@ -140,6 +325,7 @@ async def _process_bundle_job(session, job, minio_client: Minio):
             session, job, JobStatus.FAILED,
             error_message=logs[:2000] if logs else "Unknown error",
         )
+    await emit_event(_redis, job)
 
     print(f"Job {job_id} finished: exit_code={exit_code}")
 
@@ -165,6 +351,7 @@ async def _process_legacy_job(session, job, executor: DockerExecutor):
     else:
         report_failure(job, exit_code, logs)
         await update_state(session, job, JobStatus.FAILED)
+    await emit_event(_redis, job)
 
     print(f"Legacy job {job.id} finished with status {job.status}")
 
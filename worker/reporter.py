@@ -1,12 +1,25 @@
 from datetime import datetime, timezone
+import redis.asyncio as redis
 from sqlalchemy.ext.asyncio import AsyncSession
 from .models import Job, JobStatus
-from prometheus_client import Counter, Histogram
+from prometheus_client import Counter, Gauge, Histogram
 
 JOBS_PROCESSED = Counter("jobs_processed_total", "Jobs processed by worker", ["status"])
 JOB_DURATION = Histogram("job_duration_seconds", "Time spent processing job")
 CACHE_HITS = Counter("cache_hits_total", "Environment cache hits")
 CACHE_MISSES = Counter("cache_misses_total", "Environment cache misses")
+CACHE_BYTES = Gauge("cache_bytes", "Disk used by the Docker daemon's image layers")
+CACHE_EVICTIONS = Counter("cache_evictions_total", "Environment images evicted to stay under the disk budget")
+ENV_BUILD_WAITS = Counter(
+    "env_build_waits_total", "Environment builds waited on instead of started", ["scope"]
+)
+ENV_IMAGE_LOADS = Counter("env_image_loads_total", "Environment images loaded from shared storage instead of built")
+ENV_IMAGE_EXPORTS = Counter("env_image_exports_total", "Environment images exported to shared storage")
+WARM_POOL_HITS = Counter("warm_pool_hits_total", "Jobs run in a pre-started container")
+WARM_POOL_MISSES = Counter("warm_pool_misses_total", "Jobs that found no pre-started container")
+
+EVENTS_STREAM = "jobs:events"
+EVENTS_MAXLEN = 100000
 
 
 async def update_state(
@@ -48,3 +61,28 @@ def report_cache(hit: bool):
         CACHE_HITS.inc()
     else:
         CACHE_MISSES.inc()
+
+
+def report_warm_pool(hit: bool):
+    if hit:
+        WARM_POOL_HITS.inc()
+    else:
+        WARM_POOL_MISSES.inc()
+
+
+async def emit_event(r: redis.Redis, job: Job):
+    """Tell the scheduler a job reached SUCCESS or FAILED without waiting for a sweep."""
+    try:
+        await r.xadd(
+            EVENTS_STREAM,
+            {
+                "job_id": str(job.id),
+                "status": job.status.value,
+                "retries_left": job.retries_left,
+                "tenant": job.tenant,
+            },
+            maxlen=EVENTS_MAXLEN,
+            approximate=True,
+        )
+    except Exception as e:
+        print(f"Failed to emit event for job {job.id}: {e}")
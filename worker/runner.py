@@ -1,17 +1,30 @@
 import docker
+from .reporter import report_warm_pool
+from .warm_pool import warm_pool
 
 docker_client = docker.from_env()
 
 
-def run_job(job_id: str, image: str, script_host_path: str, manifest: dict) -> tuple[int, str]:
-    """Run script.py bind-mounted into the resolved image.
+def run_job(job_id: str, image: str, script_host_path: str, manifest: dict, args: list = None) -> tuple[int, str]:
+    """Run script.py bind-mounted into the resolved image, with ``args``
+    appended to its command line.
+
+    With the warm pool enabled, a pre-started container for the image and
+    limits is used when one is idle.
 
     Returns (exit_code, logs).
     """
+    if warm_pool.enabled:
+        key = (image, float(manifest.get("cpu_limit", 1)), manifest.get("mem_limit", "512m"))
+        result = warm_pool.run(key, script_host_path, manifest.get("env", {}), args or [])
+        report_warm_pool(result is not None)
+        if result is not None:
+            return result
+
     try:
         container = docker_client.containers.run(
             image=image,
-            command=["python3", "/job/script.py"],
+            command=["python3", "/job/script.py", *(args or [])],
             volumes={
                 script_host_path: {"bind": "/job/script.py", "mode": "ro"}
             },
@@ -0,0 +1,114 @@
+import asyncio
+import collections
+import contextlib
+import os
+import re
+
+DEFAULT_CPU_LIMIT = 1.0
+DEFAULT_MEM_LIMIT = "512m"
+
+_MEM_UNITS = {"": 1 / 2**20, "b": 1 / 2**20, "k": 1 / 1024, "m": 1, "g": 1024}
+
+
+def host_mem_mb() -> int:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2**20
+
+
+def parse_mem_mb(value) -> int:
+    """Megabytes in a Docker memory limit such as ``512m`` or ``2g``."""
+    match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([bkmg]?)b?\s*", str(value).lower())
+    if not match:
+        raise ValueError(f"Invalid memory limit: {value!r}")
+    return max(1, int(float(match.group(1)) * _MEM_UNITS[match.group(2)]))
+
+
+def job_demand(manifest: dict) -> tuple[float, int]:
+    """CPUs and memory (MB) a job's container is limited to, as the runner
+    will start it."""
+    manifest = manifest or {}
+    return (
+        float(manifest.get("cpu_limit", DEFAULT_CPU_LIMIT)),
+        parse_mem_mb(manifest.get("mem_limit", DEFAULT_MEM_LIMIT)),
+    )
+
+
+class SlotPool:
+    """Job slots plus CPU and memory budgets shared by the jobs on this worker.
+
+    A job waits in a FIFO queue until a slot is free and its limits fit in
+    what the running jobs leave; a job larger than the whole budget runs on
+    its own. Strict FIFO means a large job at the head is not starved by a
+    stream of small ones.
+    """
+
+    def __init__(self, slots: int, cpus: float, mem_mb: int):
+        self.slots = slots
+        self.cpus = cpus
+        self.mem_mb = mem_mb
+        self.running = 0
+        self.cpus_in_use = 0.0
+        self.mem_mb_in_use = 0
+        self._waiters = collections.deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def usage(self) -> dict:
+        return {
+            "running": self.running,
+            "queued": self.queued,
+            "cpus": self.cpus,
+            "cpus_in_use": self.cpus_in_use,
+            "mem_mb": self.mem_mb,
+            "mem_mb_in_use": self.mem_mb_in_use,
+        }
+
+    def _fits(self, cpu: float, mem_mb: int) -> bool:
+        if self.running == 0:
+            return True
+        return (
+            self.running < self.slots
+            and self.cpus_in_use + cpu <= self.cpus
+            and self.mem_mb_in_use + mem_mb <= self.mem_mb
+        )
+
+    def _take(self, cpu: float, mem_mb: int):
+        self.running += 1
+        self.cpus_in_use += cpu
+        self.mem_mb_in_use += mem_mb
+
+    def _release(self, cpu: float, mem_mb: int):
+        self.running -= 1
+        self.cpus_in_use -= cpu
+        self.mem_mb_in_use -= mem_mb
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self._fits(*self._waiters[0][:2]):
+            cpu, mem_mb, granted = self._waiters.popleft()
+            self._take(cpu, mem_mb)
+            granted.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, cpu: float, mem_mb: int):
+        """Hold a slot and ``cpu`` / ``mem_mb`` of the budget for the block."""
+        if self._waiters or not self._fits(cpu, mem_mb):
+            waiter = (cpu, mem_mb, asyncio.get_running_loop().create_future())
+            self._waiters.append(waiter)
+            try:
+                await waiter[2]
+            except asyncio.CancelledError:
+                if waiter[2].cancelled():
+                    self._waiters.remove(waiter)
+                    self._wake()
+                else:
+                    # Granted just as we were cancelled: hand it back.
+                    self._release(cpu, mem_mb)
+                raise
+        else:
+            self._take(cpu, mem_mb)
+        try:
+            yield
+        finally:
+            self._release(cpu, mem_mb)
@@ -0,0 +1,196 @@
+import collections
+import os
+import shutil
+import threading
+import uuid
+import docker
+
+docker_client = docker.from_env()
+
+# Idle containers kept per environment; 0 disables the pool.
+WARM_POOL_SIZE = int(os.getenv("WARM_POOL_SIZE", "0"))
+# A container is replaced after this many jobs, or after any failure.
+WARM_POOL_MAX_USES = int(os.getenv("WARM_POOL_MAX_USES", "20"))
+# Environments pooled at once; the least recently used one is dropped.
+WARM_POOL_MAX_IMAGES = int(os.getenv("WARM_POOL_MAX_IMAGES", "4"))
+WORKER_ID = os.getenv("HOSTNAME", "worker-1")
+WARM_DIR = os.path.join(os.getenv("TMP_JOBS_DIR", "/tmp/jobs"), "warm", WORKER_ID)
+# Labelled with the owning worker, since workers may share a Docker daemon.
+POOL_LABEL = "scheduler.warm_pool"
+
+# Keeps PID 1 alive without a shell, so any Python image will do.
+IDLE_COMMAND = ["python3", "-c", "import time\nwhile True: time.sleep(3600)"]
+
+# Run after every job: kill whatever the job left running and empty the
+# writable mounts, then print how many processes were left behind.
+RESET_SCRIPT = """
+import os, shutil, signal
+stray = [int(p) for p in os.listdir('/proc') if p.isdigit() and int(p) not in (1, os.getpid())]
+for pid in stray:
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except OSError:
+        pass
+for root in ('/tmp', '/dev/shm'):
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+print(len(stray))
+"""
+
+
+class WarmContainer:
+    def __init__(self, container, job_dir: str):
+        self.container = container
+        self.job_dir = job_dir
+        self.uses = 0
+
+
+class WarmPool:
+    """Pre-started containers per (image, cpu_limit, mem_limit).
+
+    Containers run with the same limits and isolation as a one-off job
+    container and idle until a job arrives. The job's script is copied into
+    a directory bind-mounted read-only at /job and run with ``exec``, so the
+    job skips container create/start and the interpreter boot. An image
+    joins the pool the first time a job needs it; that job runs cold.
+
+    Between jobs the container's /tmp and /dev/shm are emptied, and one
+    that a job left processes running in is replaced rather than reused,
+    so nothing carries over from one job (or tenant) to the next.
+    """
+
+    def __init__(self, size: int = WARM_POOL_SIZE, max_uses: int = WARM_POOL_MAX_USES,
+                 max_images: int = WARM_POOL_MAX_IMAGES):
+        self.size = size
+        self.max_uses = max_uses
+        self.max_images = max_images
+        self._idle: "collections.OrderedDict[tuple, list[WarmContainer]]" = collections.OrderedDict()
+        self._starting: dict[tuple, int] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def take(self, key: tuple):
+        """An idle container for ``key``, or None; either way the pool
+        starts refilling in the background."""
+        with self._lock:
+            evicted = []
+            if key not in self._idle:
+                self._idle[key] = []
+                while len(self._idle) > self.max_images:
+                    _, dropped = self._idle.popitem(last=False)
+                    evicted.extend(dropped)
+            self._idle.move_to_end(key)
+            warm = self._idle[key].pop() if self._idle[key] else None
+            missing = self.size - len(self._idle[key]) - self._starting.get(key, 0)
+            self._starting[key] = self._starting.get(key, 0) + max(missing, 0)
+        for _ in range(missing):
+            threading.Thread(target=self._start, args=(key,), daemon=True).start()
+        for w in evicted:
+            self._discard(w)
+        return warm
+
+    def give_back(self, key: tuple, warm: WarmContainer, ok: bool):
+        if not ok or warm.uses >= self.max_uses:
+            self._discard(warm)
+            return
+        with self._lock:
+            if key in self._idle and len(self._idle[key]) < self.size:
+                self._idle[key].append(warm)
+                return
+        self._discard(warm)
+
+    def _start(self, key: tuple):
+        image, cpu_limit, mem_limit = key
+        job_dir = os.path.join(WARM_DIR, uuid.uuid4().hex)
+        warm = None
+        try:
+            os.makedirs(job_dir)
+            container = docker_client.containers.run(
+                image=image,
+                command=IDLE_COMMAND,
+                volumes={job_dir: {"bind": "/job", "mode": "ro"}},
+                mem_limit=mem_limit,
+                nano_cpus=int(cpu_limit * 1e9),
+                network_disabled=True,
+                read_only=True,
+                tmpfs={"/tmp": ""},
+                labels={POOL_LABEL: WORKER_ID},
+                detach=True,
+            )
+            warm = WarmContainer(container, job_dir)
+        except Exception as e:
+            print(f"Warm pool: could not start a container for {image}: {e}")
+            shutil.rmtree(job_dir, ignore_errors=True)
+        finally:
+            with self._lock:
+                self._starting[key] -= 1
+                if warm and key in self._idle and len(self._idle[key]) < self.size:
+                    self._idle[key].append(warm)
+                    warm = None
+        if warm:
+            self._discard(warm)
+
+    def _discard(self, warm: WarmContainer):
+        try:
+            warm.container.remove(force=True)
+        except Exception as e:
+            print(f"Warm pool: could not remove {warm.container.id[:12]}: {e}")
+        shutil.rmtree(warm.job_dir, ignore_errors=True)
+
+    def run(self, key: tuple, script_host_path: str, env: dict, args: list):
+        """Run a script in a warm container; None on a miss."""
+        warm = self.take(key)
+        if warm is None:
+            return None
+        ok = False
+        try:
+            shutil.copyfile(script_host_path, os.path.join(warm.job_dir, "script.py"))
+            exit_code, output = warm.container.exec_run(
+                ["python3", "/job/script.py", *args], environment=env,
+            )
+            warm.uses += 1
+            ok = exit_code == 0
+            return exit_code, output.decode("utf-8", errors="replace")
+        except Exception as e:
+            return 1, str(e)
+        finally:
+            self.give_back(key, warm, ok and self._reset(warm))
+
+    def _reset(self, warm: WarmContainer) -> bool:
+        """Clean up after a job; False if the container should be replaced."""
+        try:
+            os.remove(os.path.join(warm.job_dir, "script.py"))
+            exit_code, output = warm.container.exec_run(["python3", "-c", RESET_SCRIPT])
+            if exit_code != 0:
+                return False
+            stray = int(output.decode("utf-8").strip() or 0)
+            if stray:
+                print(f"Warm pool: job left {stray} processes in {warm.container.id[:12]}, replacing it")
+            return stray == 0
+        except Exception as e:
+            print(f"Warm pool: could not reset {warm.container.id[:12]}: {e}")
+            return False
+
+
+def remove_stale_containers():
+    """Remove pool containers left behind by an earlier run of this worker."""
+    stale = docker_client.containers.list(all=True, filters={"label": f"{POOL_LABEL}={WORKER_ID}"})
+    for container in stale:
+        try:
+            container.remove(force=True)
+        except Exception as e:
+            print(f"Warm pool: could not remove {container.id[:12]}: {e}")
+    shutil.rmtree(WARM_DIR, ignore_errors=True)
+
+
+warm_pool = WarmPool()